@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from cyber_controller_mock import MockController, create_server, load_behaviors
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = '100,1000'
+MOCK_USERNAME = 'radware'
+MOCK_PASSWORD = 'radware'
+
+# Scripts run against the mock, in this order: the upload and the update
+# read the files the download writes. "source" scripts run against a
+# populated controller, "destination" ones against an empty one.
+BENCHMARKS = [
+    ('download', 'download_cybercontroller_objects.py', 'download.ini', 'source', []),
+    ('upload', 'upload_cybercontroller_objects.py', 'upload.ini', 'destination', []),
+    ('update', 'update_cybercontroller_objects.py', 'update.ini', 'source',
+     ['-p', 'cyber_controller_physical.json', '-o', 'cyber_controller_organization.json']),
+]
+
+
+class MockServer:
+    """A mock controller served from a background thread on a free local port."""
+
+    def __init__(self, devices, behaviors, sites=None):
+        self.controller = MockController(devices, sites, behaviors=behaviors,
+                                         username=MOCK_USERNAME, password=MOCK_PASSWORD)
+        self.server = create_server(self.controller, port=0)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def requests(self):
+        return self.controller.stats_response()["requests"]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_ini(filename, url):
+    with open(filename, 'w') as f:
+        f.write(f"[credentials]\nip = {url}\nusername = {MOCK_USERNAME}\npassword = {MOCK_PASSWORD}\n")
+
+
+def run_script(script, arguments, directory):
+    """Run a script in directory and return (exit code, seconds, peak RSS in MB or None)."""
+    with open(os.path.join(directory, os.path.splitext(script)[0] + '.out'), 'w') as output:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)] + arguments,
+                                   cwd=directory, stdout=output, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL)
+        if not hasattr(os, 'wait4'):
+            # No resource usage of a single child on Windows
+            return process.wait(), time.perf_counter() - start, None
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return process.returncode, seconds, peak_rss
+
+
+def run_size(devices, directory, behaviors, script_arguments, benchmarks):
+    """Run the benchmarks for one inventory size and return one result per script."""
+    os.makedirs(directory, exist_ok=True)
+    servers = {'source': MockServer(devices, behaviors), 'destination': MockServer(0, behaviors, sites=0)}
+    results = []
+    try:
+        for name, script, ini, target, arguments in BENCHMARKS:
+            if name not in benchmarks:
+                continue
+            server = servers[target]
+            write_ini(os.path.join(directory, ini), server.url)
+            requests_before = server.requests()
+            returncode, seconds, peak_rss = run_script(script, script_arguments + arguments, directory)
+            request_count = server.requests() - requests_before
+            results.append({
+                "script": name,
+                "devices": devices,
+                "returncode": returncode,
+                "seconds": seconds,
+                "requests": request_count,
+                "requests_per_second": request_count / seconds if seconds else 0.0,
+                "peak_rss_mb": peak_rss
+            })
+            print_result(results[-1])
+    finally:
+        for server in servers.values():
+            server.close()
+    return results
+
+
+def print_result(result):
+    peak_rss = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else '-'
+    status = 'ok' if result['returncode'] == 0 else f"exit code {result['returncode']}"
+    print(f"{result['script']:<10}{result['devices']:>8}{result['seconds']:>10.2f}{result['requests']:>10}"
+          f"{result['requests_per_second']:>10.1f}{peak_rss:>10}  {status}", flush=True)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the download, upload and update scripts against a local mock Cyber-Controller')
+    parser.add_argument('-n', '--sizes', default=DEFAULT_SIZES,
+                        help=f'Comma separated numbers of devices per tree (default: {DEFAULT_SIZES})')
+    parser.add_argument('-b', '--benchmarks', default=','.join(name for name, *_ in BENCHMARKS),
+                        help='Comma separated scripts to run (default: all of them)')
+    parser.add_argument('-c', '--concurrency', type=int, default=None,
+                        help='Parallel requests of the scripts (default: the script defaults)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Seconds the mock adds to every request (default: 0)')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='Share of the requests the mock answers 500 (default: 0)')
+    parser.add_argument('-r', '--rate-limit', type=float, default=None,
+                        help='Requests per second per endpoint above which the mock answers 429 (default: no limit)')
+    parser.add_argument('-f', '--config', default=None,
+                        help='Mock ini file with per-endpoint behaviors (see mock.example)')
+    parser.add_argument('-d', '--dir', default=None,
+                        help='Directory for the files of the runs, kept afterwards (default: a temporary one)')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file for the results (default: benchmark.json)')
+    args = parser.parse_args()
+    try:
+        args.sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError:
+        parser.error('the sizes must be comma separated numbers')
+    args.benchmarks = [name.strip() for name in args.benchmarks.split(',')]
+    unknown = set(args.benchmarks) - {name for name, *_ in BENCHMARKS}
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_arguments()
+    behaviors = load_behaviors(args.config, args.latency, args.error_rate, args.rate_limit)
+    # Every run logs in, as the first run of a session cache would
+    script_arguments = ['--session-cache', '0'] + (['-c', str(args.concurrency)] if args.concurrency else [])
+    base_dir = args.dir or tempfile.mkdtemp(prefix='cyber_controller_benchmark_')
+
+    print(f"{'script':<10}{'devices':>8}{'seconds':>10}{'requests':>10}{'req/s':>10}{'RSS MB':>10}")
+    results = []
+    try:
+        for devices in args.sizes:
+            results += run_size(devices, os.path.join(base_dir, str(devices)), behaviors, script_arguments,
+                                args.benchmarks)
+    finally:
+        if not args.dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({"latency": args.latency, "error_rate": args.error_rate, "rate_limit": args.rate_limit,
+                   "results": results}, f, indent=4)
+    print(f"Results have been written to {args.output}")
+
+    # Fail when a script failed, so the benchmark can gate a build
+    if any(result["returncode"] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
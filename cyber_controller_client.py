@@ -0,0 +1,274 @@
+import os
+import threading
+import time
+import json
+import hashlib
+import logging
+import requests
+import urllib3
+from cyber_controller_metrics import Metrics
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+DEFAULT_CONCURRENCY = 8
+
+# Status codes the Cyber-Controller returns once the login session has expired.
+# 403 also means that the user lacks the permission, so it is only trusted once:
+# a 403 on the session of a login made after a 403 is returned as is
+SESSION_EXPIRED_STATUS_CODES = (401, 403)
+FORBIDDEN_STATUS_CODE = 403
+
+# A cached login session is reused for this many seconds after the login
+DEFAULT_SESSION_CACHE_SECONDS = 600
+DEFAULT_SESSION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cyber_controller', 'sessions')
+
+
+def orm_id_from_response(data):
+    """Return the ormID from a site/device response body, or None."""
+    if not isinstance(data, dict):
+        return None
+    if 'meIdentifier' in data and 'managedElementID' in data['meIdentifier']:
+        return data['meIdentifier']['managedElementID']
+    return data.get('ormID')
+
+
+def device_access_from_response(response):
+    """Return the deviceAccess of a /device/byip response without its ormID."""
+    data = json.loads(response.text)
+    device_access_data = data["deviceSetup"]['deviceAccess']
+    device_access_data.pop('ormID', None)
+    return device_access_data
+
+
+class SessionCache:
+    """The login cookies of one Cyber-Controller and user, kept on disk between runs.
+
+    The file is named after a hash of the controller address and the
+    username, holds the cookies and the time of the login (no password) and
+    is only readable by its owner (0600, in a 0700 directory). It is
+    written to a temporary file and renamed, so scripts running at the same
+    time never read half of it. A session is only reused within max_age
+    seconds of its login and while none of its cookies has expired; the
+    controller gets the final say on the first request, see
+    CyberControllerClient.
+    """
+
+    def __init__(self, base_url, username, max_age=DEFAULT_SESSION_CACHE_SECONDS,
+                 directory=DEFAULT_SESSION_CACHE_DIR):
+        self.base_url = base_url
+        self.username = username
+        self.max_age = max_age
+        self.directory = directory
+        key = hashlib.sha256(f'{base_url}\n{username}'.encode()).hexdigest()[:32]
+        self.filename = os.path.join(directory, key + '.json')
+
+    def load(self):
+        """Return (cookies, logged_in) of a session that is still fresh, or None."""
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+            cookies = data['cookies']
+            logged_in = data['logged_in']
+            if data['base_url'] != self.base_url or data['username'] != self.username:
+                return None
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Ignoring the session cache {self.filename}: {str(e)}")
+            return None
+
+        now = time.time()
+        if (not cookies or now - logged_in >= self.max_age
+                or any(cookie['expires'] and cookie['expires'] <= now for cookie in cookies)):
+            self.remove()
+            return None
+        return cookies, logged_in
+
+    def save(self, cookies, logged_in):
+        data = {
+            "base_url": self.base_url,
+            "username": self.username,
+            "logged_in": logged_in,
+            "cookies": cookies
+        }
+        temporary = f'{self.filename}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            logging.error(f"Could not write the session cache {self.filename}: {str(e)}")
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class CyberControllerClient:
+    """A logged-in session to one Cyber-Controller.
+
+    The client logs in once and keeps a keep-alive connection pool with one
+    connection per worker, so every request of a run reuses the same TLS
+    connections. When the controller reports that the session has expired
+    the client logs in again and retries the request once (after a 403, only
+    if the session did not come from a login made after a 403). The client can be
+    shared between worker threads; only one of them re-authenticates.
+    Every request is measured in self.metrics (see cyber_controller_metrics.py).
+
+    With session_cache_seconds, the session cookies are saved after each
+    login (see SessionCache) and a fresh saved session is reused instead of
+    logging in. It is not checked with an extra request: if the controller
+    has dropped it, the first request gets a 401 and goes through the usual
+    login and retry.
+    """
+
+    def __init__(self, ip, username, password, concurrency=DEFAULT_CONCURRENCY, supportasync=False,
+                 session_cache_seconds=0):
+        self.ip = ip
+        self.username = username
+        self.password = password
+        # An address with a scheme (e.g. http://127.0.0.1:8080 for the mock controller) is used as is
+        self.base_url = ip.rstrip('/') if ip.startswith(('http://', 'https://')) else 'https://' + ip
+        self.concurrency = max(1, concurrency)
+        self.supportasync = supportasync
+
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+        # The current session comes from a login made after a 403
+        self._forbidden_login = False
+        self._logged_in = None
+        self.metrics = Metrics()
+        self.session = self._create_session()
+        self.session_cache = SessionCache(self.base_url, username, session_cache_seconds) \
+            if session_cache_seconds > 0 else None
+
+        if not (self._resume_session() or self.login()):
+            print("Cyber-Controller " + ip + " login status code:", self.last_login_status)
+            logging.info('Finishing the script.')
+            exit(1)
+
+    def _headers(self):
+        headers = {
+            'authority': self.base_url.split('://', 1)[1],
+            'accept': 'application/json; */*',
+            "accept-encoding": "gzip, deflate, br",
+            'accept-language': 'en-US,en;q=0.9,he;q=0.8',
+            'content-type': 'application/json',
+            'sec-ch-ua': '"Google Chrome";v="113", "Chromium";v="113", "Not-A.Brand";v="24"',
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-platform': '"Windows"',
+            'sec-fetch-dest': 'empty',
+            'sec-fetch-mode': 'cors',
+            'sec-fetch-site': 'same-origin',
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
+                          ' Chrome/113.0.0.0 Safari/537.36'
+        }
+        if self.supportasync:
+            headers['supportasync'] = 'true'
+        return headers
+
+    def _create_session(self):
+        session = requests.Session()
+        session.auth = (self.username, self.password)
+        session.verify = False
+        session.headers = self._headers()
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def login(self):
+        """POST the login request. Returns True when the controller accepted it."""
+        login_data = {"username": self.username, "password": self.password}
+        login_response = self._send('POST', '/mgmt/system/user/login', json=login_data, verify=False)
+        self.last_login_status = login_response.status_code
+        if login_response.status_code != 200:
+            logging.error("Cyber-Controller " + self.ip + " login status code: " + str(login_response.status_code))
+            self._logged_in = None
+            if self.session_cache:
+                self.session_cache.remove()
+            return False
+
+        self._login_generation += 1
+        self._logged_in = time.time()
+        logging.info("Logged in to Cyber-Controller " + self.ip)
+        self._save_session()
+        return True
+
+    def _resume_session(self):
+        """Reuse the cached session, if there is a fresh one. Returns True when it was."""
+        cached = self.session_cache.load() if self.session_cache else None
+        if cached is None:
+            return False
+        cookies, self._logged_in = cached
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'],
+                                     path=cookie['path'], secure=cookie['secure'], expires=cookie['expires'])
+        self._login_generation += 1
+        logging.info(f"Reusing the session of Cyber-Controller {self.ip} cached"
+                     f" {time.time() - self._logged_in:.0f}s ago")
+        return True
+
+    def _save_session(self):
+        if self.session_cache and self._logged_in:
+            cookies = [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+                        "secure": cookie.secure, "expires": cookie.expires} for cookie in self.session.cookies]
+            self.session_cache.save(cookies, self._logged_in)
+
+    def _relogin(self, generation, forbidden=False):
+        with self._login_lock:
+            # Another worker already logged in again while we were waiting
+            if generation != self._login_generation:
+                return True
+            # A fresh session refused too: the user lacks the permission, logging in again won't help
+            if forbidden and self._forbidden_login:
+                return False
+            logging.info("Cyber-Controller " + self.ip + " session expired, logging in again")
+            if not self.login():
+                return False
+            self._forbidden_login = forbidden
+            return True
+
+    def url(self, path):
+        return self.base_url + path
+
+    def _send(self, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.record(method, path, 'error', time.perf_counter() - start)
+            raise
+        body = response.request.body
+        self.metrics.record(method, path, response.status_code, time.perf_counter() - start,
+                            len(body) if body else 0, len(response.content))
+        return response
+
+    def request(self, method, path, **kwargs):
+        # Passed on every request: session.verify is overridden by REQUESTS_CA_BUNDLE
+        kwargs.setdefault('verify', False)
+        generation = self._login_generation
+        response = self._send(method, path, **kwargs)
+        if (response.status_code in SESSION_EXPIRED_STATUS_CODES
+                and self._relogin(generation, response.status_code == FORBIDDEN_STATUS_CODE)):
+            response = self._send(method, path, **kwargs)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def close(self):
+        # The controller may have renewed the cookies during the run
+        self._save_session()
+        self.session.close()
@@ -0,0 +1,200 @@
+import json
+import sqlite3
+import logging
+from pathlib import Path
+
+DEFAULT_DB_FILE = 'cyber_controller.db'
+
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+# Each record is kept as its exported JSON (without deviceAccess for devices)
+# next to the columns it is looked up by, so a tree reads back exactly as it
+# was exported. seq keeps the export order.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trees (
+    tree TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS sites (
+    seq INTEGER PRIMARY KEY,
+    tree TEXT NOT NULL,
+    id TEXT,
+    name TEXT,
+    parentOrmID TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sites_id ON sites (tree, id);
+CREATE INDEX IF NOT EXISTS sites_name ON sites (tree, name);
+CREATE INDEX IF NOT EXISTS sites_parent ON sites (tree, parentOrmID);
+CREATE TABLE IF NOT EXISTS devices (
+    seq INTEGER PRIMARY KEY,
+    tree TEXT NOT NULL,
+    id TEXT,
+    name TEXT,
+    type TEXT,
+    managementIp TEXT,
+    parentOrmID TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_id ON devices (tree, id);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (tree, name);
+CREATE INDEX IF NOT EXISTS devices_ip ON devices (tree, managementIp);
+CREATE INDEX IF NOT EXISTS devices_parent ON devices (tree, parentOrmID);
+CREATE TABLE IF NOT EXISTS device_access (
+    device_seq INTEGER PRIMARY KEY REFERENCES devices (seq) ON DELETE CASCADE,
+    record TEXT NOT NULL
+);
+'''
+
+
+def is_sqlite(filename):
+    """Tell an SQLite database from a JSON or NDJSON export by its header."""
+    with open(filename, 'rb') as f:
+        return f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
+
+
+class InventoryStore:
+    """Exports of both trees in one SQLite database.
+
+    Sites, devices and their deviceAccess are kept in separate tables,
+    indexed by id, name, managementIp and parentOrmID, so the tools can
+    query a few sites out of a large inventory instead of parsing all of
+    it. A tree is replaced as a whole when it is saved again.
+    """
+
+    def __init__(self, filename=DEFAULT_DB_FILE, readonly=False):
+        self.filename = filename
+        if readonly:
+            # mode=ro fails on a missing file instead of creating an empty database
+            self._connection = sqlite3.connect(Path(filename).absolute().as_uri() + '?mode=ro', uri=True)
+        else:
+            self._connection = sqlite3.connect(filename)
+            self._connection.executescript(SCHEMA)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+
+    def clear_tree(self, tree):
+        """Remove a tree and mark it as stored, so it can be written again record by record."""
+        self._connection.execute('DELETE FROM sites WHERE tree = ?', (tree,))
+        self._connection.execute('DELETE FROM devices WHERE tree = ?', (tree,))
+        self._connection.execute('INSERT OR IGNORE INTO trees (tree) VALUES (?)', (tree,))
+
+    def add(self, tree, kind, record):
+        """Insert one "site" or "device" record. Call commit() once the tree is written."""
+        if kind == "site":
+            self._connection.execute(
+                'INSERT INTO sites (tree, id, name, parentOrmID, record) VALUES (?, ?, ?, ?, ?)',
+                (tree, record.get('id'), record.get('name'), record.get('parentOrmID'), json.dumps(record)))
+            return
+
+        device = dict(record)
+        device_access = device.pop('deviceAccess', None)
+        cursor = self._connection.execute(
+            'INSERT INTO devices (tree, id, name, type, managementIp, parentOrmID, record)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (tree, device.get('id'), device.get('name'), device.get('type'), device.get('managementIp'),
+             device.get('parentOrmID'), json.dumps(device)))
+        if device_access is not None:
+            self._connection.execute('INSERT INTO device_access (device_seq, record) VALUES (?, ?)',
+                                     (cursor.lastrowid, json.dumps(device_access)))
+
+    def save_tree(self, tree, data):
+        """Replace a tree with an export ({"sites": [...], "devices": [...]}) in one transaction."""
+        with self._connection:
+            self.clear_tree(tree)
+            for site in data.get('sites', []):
+                self.add(tree, "site", site)
+            for device in data.get('devices', []):
+                self.add(tree, "device", device)
+
+    def commit(self):
+        self._connection.commit()
+
+    def has_tree(self, tree):
+        return self._connection.execute('SELECT 1 FROM trees WHERE tree = ?', (tree,)).fetchone() is not None
+
+    def _select_sites(self, tree, site_names, subtree):
+        """Fill the temporary selected_ids table with the ids of the selected sites."""
+        self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_names (name TEXT PRIMARY KEY)')
+        self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_ids (id TEXT PRIMARY KEY)')
+        self._connection.execute('DELETE FROM selected_names')
+        self._connection.execute('DELETE FROM selected_ids')
+        self._connection.executemany('INSERT OR IGNORE INTO selected_names (name) VALUES (?)',
+                                     ((name,) for name in site_names))
+        self._connection.execute(
+            'INSERT OR IGNORE INTO selected_ids (id) SELECT id FROM sites'
+            ' WHERE tree = ? AND name IN (SELECT name FROM selected_names)', (tree,))
+        if subtree:
+            # Walk down the parentOrmID index; UNION drops ids already found, so a cycle ends the walk
+            self._connection.execute(
+                'INSERT OR IGNORE INTO selected_ids (id)'
+                ' WITH RECURSIVE closure (id) AS ('
+                ' SELECT id FROM selected_ids'
+                ' UNION SELECT s.id FROM sites s JOIN closure c ON s.tree = ? AND s.parentOrmID = c.id)'
+                ' SELECT id FROM closure', (tree,))
+
+    def records(self, tree, kind=None, site_names=None, subtree=False):
+        """Yield (kind, record) of a tree in export order, the sites first.
+
+        With site_names, only the sites with those names and the devices
+        directly under them are read, through the name and parentOrmID
+        indexes. With subtree, all the descendant sites of the named sites
+        and their devices are read as well.
+        """
+        site_filter = ''
+        device_filter = ''
+        if site_names is not None:
+            self._select_sites(tree, site_names, subtree)
+            site_filter = ' AND id IN (SELECT id FROM selected_ids)'
+            device_filter = ' AND d.parentOrmID IN (SELECT id FROM selected_ids)'
+
+        if kind in (None, "site"):
+            for (record,) in self._connection.execute(
+                    'SELECT record FROM sites WHERE tree = ?' + site_filter + ' ORDER BY seq', (tree,)):
+                yield "site", json.loads(record)
+
+        if kind in (None, "device"):
+            for record, device_access in self._connection.execute(
+                    'SELECT d.record, a.record FROM devices d LEFT JOIN device_access a ON a.device_seq = d.seq'
+                    ' WHERE d.tree = ?' + device_filter + ' ORDER BY d.seq', (tree,)):
+                device = json.loads(record)
+                if device_access is not None:
+                    device['deviceAccess'] = json.loads(device_access)
+                yield "device", device
+
+    def export(self, tree):
+        """Return a tree as an export dictionary, or None if the tree was never stored."""
+        if not self.has_tree(tree):
+            return None
+        data = {"sites": [], "devices": []}
+        for kind, record in self.records(tree):
+            data["sites" if kind == "site" else "devices"].append(record)
+        return data
+
+    def close(self):
+        self._connection.close()
+
+
+def iter_db_records(filename, tree, kind=None, site_names=None, subtree=False):
+    """Yield (kind, record) of one tree of a database, like InventoryStore.records()."""
+    store = InventoryStore(filename, readonly=True)
+    try:
+        yield from store.records(tree, kind, site_names, subtree)
+    finally:
+        store.close()
+
+
+def load_tree(filename, tree):
+    """Read one tree of a database as an export dictionary, or None if it can't be read."""
+    try:
+        store = InventoryStore(filename, readonly=True)
+        try:
+            data = store.export(tree)
+        finally:
+            store.close()
+    except sqlite3.Error as e:
+        logging.error(f"Error reading database {filename}: {str(e)}")
+        print(f"Error: Could not read database {filename}: {str(e)}")
+        return None
+    if data is None:
+        logging.error(f"No {tree} tree in database {filename}")
+        print(f"Error: No {tree} tree in database {filename}")
+    return data
@@ -0,0 +1,129 @@
+import os
+import random
+import argparse
+from cyber_controller_mock import device_ip, device_access
+from cyber_controller_stream import JsonExportWriter
+
+TREES = ('Physical', 'Organization')
+DEFAULT_CLI_USERS = 'radware=70,admin=20,ops01=5,ops02=5'
+DEFAULT_SNMP_USERS = 'radsnmp=80,radsnmp2=20'
+
+
+def parse_weights(value):
+    """Parse "name=weight,name=weight" into (names, weights). A name without a weight counts 1."""
+    names = []
+    weights = []
+    for item in value.split(','):
+        name, _, weight = item.strip().partition('=')
+        if not name:
+            raise ValueError(f"empty name in {value!r}")
+        names.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    if sum(weights) <= 0:
+        raise ValueError(f"the weights of {value!r} add up to 0")
+    return names, weights
+
+
+def site_count(depth, fanout):
+    """Number of sites of a full tree (the root excluded)."""
+    return sum(fanout ** level for level in range(1, depth + 1))
+
+
+def generate_export(filename, tree, devices, depth=3, fanout=5, alteon_share=0.5,
+                    cli_users=None, snmp_users=None, rng=None):
+    """Write one synthetic tree export, like the download writes it.
+
+    The sites form a full tree of the given depth, each site with fanout
+    child sites; they are numbered breadth first, so the first fanout sites
+    are right under the root. The devices are spread at random over the
+    sites of the deepest level and named dp01 to dp04 in turn. Their type
+    is Alteon with the probability alteon_share, and their CLI/HTTP/HTTPS
+    and SNMPv3 usernames are drawn from the (names, weights) distributions.
+    Records are written as they are generated, so any number of devices
+    fits in memory. Returns the number of sites.
+    """
+    rng = rng or random.Random()
+    cli_names, cli_weights = cli_users or parse_weights(DEFAULT_CLI_USERS)
+    snmp_names, snmp_weights = snmp_users or parse_weights(DEFAULT_SNMP_USERS)
+    tree_index = TREES.index(tree) + 1
+    root_id = f"{tree}-root"
+
+    with JsonExportWriter(filename) as writer:
+        parents = [(root_id, tree)]
+        leaves = parents
+        number = 0
+        for level in range(depth):
+            children = []
+            for parent_id, parent_name in parents:
+                for _ in range(fanout):
+                    site = {
+                        "name": f"{tree}-site-{number}",
+                        "id": f"{tree}-s{number}",
+                        "parent_site_name": parent_name,
+                        "parentOrmID": parent_id
+                    }
+                    writer.write("site", site)
+                    children.append((site["id"], site["name"]))
+                    number += 1
+            parents = leaves = children
+
+        for number in range(devices):
+            ip = device_ip(tree_index, number)
+            cli_user = rng.choices(cli_names, cli_weights)[0]
+            access = device_access(ip)
+            access.update(cliUsername=cli_user, httpUsername=cli_user, httpsUsername=cli_user,
+                          snmpV3Username=rng.choices(snmp_names, snmp_weights)[0])
+            writer.write("device", {
+                "name": f"dp{number % 4 + 1:02d}-{tree}-{number}",
+                "type": "Alteon" if rng.random() < alteon_share else "DefensePro",
+                "managementIp": ip,
+                "id": f"{tree}-d{number}",
+                "parentOrmID": rng.choice(leaves)[0],
+                "deviceAccess": access
+            })
+    return writer.counts["site"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Generate synthetic Cyber-Controller exports for scale tests')
+    parser.add_argument('-n', '--devices', type=int, default=1000, help='Devices in each tree (default: 1000)')
+    parser.add_argument('--depth', type=int, default=3, help='Levels of sites under the root (default: 3)')
+    parser.add_argument('--fanout', type=int, default=5, help='Child sites of each site (default: 5)')
+    parser.add_argument('-a', '--alteon-share', type=float, default=0.5,
+                        help='Share of Alteon devices, the others are DefensePro (default: 0.5)')
+    parser.add_argument('--cli-users', default=DEFAULT_CLI_USERS,
+                        help=f'CLI/HTTP/HTTPS usernames and their weights (default: {DEFAULT_CLI_USERS})')
+    parser.add_argument('--snmp-users', default=DEFAULT_SNMP_USERS,
+                        help=f'SNMPv3 usernames and their weights (default: {DEFAULT_SNMP_USERS})')
+    parser.add_argument('-t', '--tree', choices=['physical', 'organization'], action='append',
+                        help='Tree to generate, can be repeated (default: both)')
+    parser.add_argument('-d', '--dir', default='.', help='Output directory (default: current directory)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, the same seed gives the same files')
+    args = parser.parse_args()
+    if args.depth < 1 or args.fanout < 1:
+        parser.error('the depth and the fanout must be at least 1')
+    if not 0 <= args.alteon_share <= 1:
+        parser.error('the Alteon share must be between 0 and 1')
+    try:
+        args.cli_users = parse_weights(args.cli_users)
+        args.snmp_users = parse_weights(args.snmp_users)
+    except ValueError as e:
+        parser.error(f'invalid usernames: {str(e)}')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    os.makedirs(args.dir, exist_ok=True)
+    rng = random.Random(args.seed)
+    for tree in TREES:
+        if args.tree and tree.lower() not in args.tree:
+            continue
+        filename = os.path.join(args.dir, f'cyber_controller_{tree.lower()}.json')
+        sites = generate_export(filename, tree, args.devices, args.depth, args.fanout, args.alteon_share,
+                                args.cli_users, args.snmp_users, rng)
+        print(f'{sites} sites and {args.devices} devices have been written to {filename}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import json
+
+
+def walk_tree(data):
+    """Yield ("site", site) and ("device", device) records from a tree response.
+
+    The walk is iterative (pre-order, same order as the tree) so deep site
+    hierarchies don't hit the recursion limit. A parent is always visited
+    before its children, so parent site names come from an id->name index
+    built during the walk instead of one API call per site.
+    """
+    site_names = {data["meIdentifier"]["managedElementID"]: data["name"]}
+
+    # Each stack entry is (item, id of the site that contains it)
+    stack = [(item, data["meIdentifier"]["managedElementID"]) for item in reversed(data.get("children", []))]
+    while stack:
+        item, parent_id = stack.pop()
+        if item["meIdentifier"]["managedElementClass"] == "com.radware.insite.model.device.Device":
+            device = {
+                "name": item["name"],
+                "type": item["type"],
+                "managementIp": item["managementIp"],
+                "id": item["meIdentifier"]["managedElementID"],
+                "parentOrmID": parent_id
+            }
+            yield "device", device
+        elif item["meIdentifier"]["managedElementClass"] == "com.radware.insite.model.device.Site":
+            site_id = item["meIdentifier"]["managedElementID"]
+            site_names[site_id] = item["name"]
+
+            site = {
+                "name": item["name"],
+                "id": site_id,
+                "parent_site_name": site_names.get(parent_id, False),
+                "parentOrmID": parent_id
+            }
+
+            yield "site", site
+            stack.extend((child, site_id) for child in reversed(item.get("children", [])))
+
+
+def extract_sites_and_devices(data):
+    """Walk the tree response and return flat site and device lists."""
+    sites = []
+    devices = []
+    for kind, record in walk_tree(data):
+        if kind == "site":
+            sites.append(record)
+        else:
+            devices.append(record)
+    return sites, devices
+
+
+class Inventory:
+    """Sites and devices of one export, with hash indexes for O(1) lookups.
+
+    The export keeps its original layout ({"sites": [...], "devices": [...]}).
+    Lookups by id, name, managementIp and parentOrmID use dictionaries built
+    once when the inventory is loaded. On duplicate keys the first record
+    wins, the same as the linear scans this replaces.
+    """
+
+    def __init__(self, json_data=None):
+        self.data = json_data if json_data is not None else {}
+        self.root_name = None
+        self.root_id = None
+        self.sites = self.data.setdefault('sites', [])
+        self.devices = self.data.setdefault('devices', [])
+
+        self.sites_by_id = {}
+        self.sites_by_name = {}
+        self.children_by_parent = {}
+        self.devices_by_id = {}
+        self.devices_by_ip = {}
+        self.devices_by_parent = {}
+
+        for site in self.sites:
+            self._index_site(site)
+        for device in self.devices:
+            self._index_device(device)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_tree(cls, data):
+        """Build an inventory from a /mgmt/system/config/tree/<type> response.
+
+        The root site of the tree is not part of the sites list, but it can be
+        found by name with site_id_by_name().
+        """
+        sites, devices = extract_sites_and_devices(data)
+        inventory = cls({'sites': sites, 'devices': devices})
+        inventory.root_name = data["name"]
+        inventory.root_id = data["meIdentifier"]["managedElementID"]
+        return inventory
+
+    def _index_site(self, site):
+        self.sites_by_id.setdefault(site.get('id'), site)
+        self.sites_by_name.setdefault(site.get('name'), site)
+        self.children_by_parent.setdefault(site.get('parentOrmID'), []).append(site)
+
+    def _index_device(self, device):
+        self.devices_by_id.setdefault(device.get('id'), device)
+        self.devices_by_ip.setdefault(device.get('managementIp'), device)
+        self.devices_by_parent.setdefault(device.get('parentOrmID'), []).append(device)
+
+    def add_site(self, site):
+        self.sites.append(site)
+        self._index_site(site)
+
+    def add_device(self, device):
+        self.devices.append(device)
+        self._index_device(device)
+
+    def site_by_id(self, site_id):
+        return self.sites_by_id.get(site_id)
+
+    def site_by_name(self, site_name):
+        return self.sites_by_name.get(site_name)
+
+    def site_id_by_name(self, site_name):
+        """Return the id of the site with this name (the root included), or None."""
+        if site_name is not None and site_name == self.root_name:
+            return self.root_id
+        site = self.sites_by_name.get(site_name)
+        return site['id'] if site else None
+
+    def site_name(self, site_id):
+        """Return the name of the site with this id, or None if it is not in the export."""
+        site = self.sites_by_id.get(site_id)
+        return site['name'] if site else None
+
+    def device_by_id(self, device_id):
+        return self.devices_by_id.get(device_id)
+
+    def device_by_ip(self, device_ip):
+        return self.devices_by_ip.get(device_ip)
+
+    def child_sites(self, site_id):
+        return self.children_by_parent.get(site_id, [])
+
+    def site_devices(self, site_id):
+        return self.devices_by_parent.get(site_id, [])
+
+    def sites_by_depth(self):
+        """Group the sites into waves by tree depth.
+
+        Wave 0 holds the sites whose parent is not in the export (children of
+        the root), wave 1 their children and so on. A site only depends on
+        sites from earlier waves, so each wave can be created in parallel.
+        """
+        depths = {}
+        waves = []
+        for site in self.sites:
+            # Walk up to the first ancestor with a known depth, then fill in the path
+            path = []
+            on_path = set()
+            current = site
+            while current is not None and id(current) not in depths:
+                if id(current) in on_path:
+                    # Broken export with a parentOrmID cycle, treat it as a top-level site
+                    current = None
+                    break
+                path.append(current)
+                on_path.add(id(current))
+                current = self.sites_by_id.get(current.get('parentOrmID'))
+            depth = depths[id(current)] + 1 if current is not None else 0
+            for ancestor in reversed(path):
+                depths[id(ancestor)] = depth
+                depth += 1
+
+            site_depth = depths[id(site)]
+            while len(waves) <= site_depth:
+                waves.append([])
+            waves[site_depth].append(site)
+        return waves
+
+    def to_dict(self):
+        return {
+            'sites': self.sites,
+            'devices': self.devices
+        }
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+import logging
+
+
+class Journal:
+    """Append-only journal of JSON records, one per line.
+
+    Every record is flushed as soon as it is appended, so a run that dies
+    halfway (VPN drop, expired session, Ctrl-C) leaves everything it
+    finished on disk. A journal opened with resume=True keeps the records
+    of the previous run, otherwise it starts empty. Appending is safe from
+    several worker threads.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self._lock = threading.Lock()
+        if resume and os.path.exists(filename):
+            self._drop_incomplete_record()
+        self._file = open(filename, 'a' if resume else 'w')
+
+    def _drop_incomplete_record(self):
+        # A crash in the middle of a write leaves a line without its newline;
+        # cut it off so new records don't get glued to it
+        with open(self.filename, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def records(self):
+        """Yield the records already in the journal.
+
+        A last line cut short by a crash is ignored.
+        """
+        with open(self.filename, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.endswith('\n'):
+                    logging.info(f"Ignoring incomplete record at line {line_number} of {self.filename}")
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.error(f"Ignoring invalid record at line {line_number} of {self.filename}")
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """Close and delete the journal once the run it protects has finished."""
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError as e:
+            logging.error(f"Error removing journal {self.filename}: {str(e)}")
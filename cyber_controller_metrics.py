@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import math
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from cyber_controller_profile import phase as profile_phase
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Path parts that identify one object are replaced by a placeholder, so
+# all the requests to the same endpoint are counted together
+ENDPOINT_TEMPLATES = [
+    (re.compile(r'^(/mgmt/system/config/tree/device/byip/)[^/]+$'), r'\1{ip}'),
+    (re.compile(r'^(/mgmt/system/config/tree/site/byname/)[^/]+$'), r'\1{name}'),
+    (re.compile(r'^(/mgmt/system/config/tree/site/byid/)[^/]+$'), r'\1{id}'),
+]
+
+
+def endpoint_template(path):
+    """Return the endpoint of a request path, e.g. /mgmt/system/config/tree/device/byip/{ip}."""
+    path = path.split('?', 1)[0]
+    for pattern, template in ENDPOINT_TEMPLATES:
+        if pattern.match(path):
+            return pattern.sub(template, path)
+    return path
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+class EndpointStats:
+    """Count, bytes, status codes and latencies of the requests to one endpoint."""
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = Counter()
+        self.latencies = []
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        summary = {
+            "count": self.count,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "statuses": dict(sorted(self.statuses.items())),
+            "seconds_total": sum(latencies),
+            "seconds_max": latencies[-1] if latencies else 0.0
+        }
+        for quantile in QUANTILES:
+            summary[f"p{int(quantile * 100)}"] = percentile(latencies, quantile)
+        return summary
+
+
+class Metrics:
+    """Request and phase measurements of one run, safe to update from worker threads.
+
+    Every request is recorded under its method and endpoint template with
+    its status code (or "error" when no response came back), the bytes
+    sent and received and its latency. Phases are named stretches of wall
+    time of the run; a phase entered several times (once per tree, say)
+    adds up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.endpoints = {}
+        self.phases = {}
+
+    def record(self, method, path, status, seconds, bytes_sent=0, bytes_received=0):
+        key = (method, endpoint_template(path))
+        with self._lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.count += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.statuses[str(status)] += 1
+            stats.latencies.append(seconds)
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the run, also in the profile report with --profile."""
+        start = time.perf_counter()
+        try:
+            with profile_phase(name):
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                phase["count"] += 1
+                phase["seconds"] += seconds
+
+    def report(self):
+        with self._lock:
+            endpoints = [dict(method=method, endpoint=endpoint, **stats.summary())
+                         for (method, endpoint), stats in sorted(self.endpoints.items())]
+            phases = {name: dict(phase) for name, phase in self.phases.items()}
+        return {
+            "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            "seconds": time.perf_counter() - self._start,
+            "requests": sum(endpoint["count"] for endpoint in endpoints),
+            "endpoints": endpoints,
+            "phases": phases
+        }
+
+    def prometheus(self, job):
+        """Return the metrics in the Prometheus text format, every sample labelled with job."""
+        report = self.report()
+        lines = [
+            '# HELP cyber_controller_requests_total Requests sent to the Cyber-Controller.',
+            '# TYPE cyber_controller_requests_total counter',
+        ]
+        for endpoint in report["endpoints"]:
+            for status, count in endpoint["statuses"].items():
+                labels = _labels(job=job, method=endpoint["method"], endpoint=endpoint["endpoint"], status=status)
+                lines.append(f'cyber_controller_requests_total{labels} {count}')
+
+        lines += [
+            '# HELP cyber_controller_request_bytes_total Bytes of the request and response bodies.',
+            '# TYPE cyber_controller_request_bytes_total counter',
+        ]
+        for endpoint in report["endpoints"]:
+            for direction in ('sent', 'received'):
+                labels = _labels(job=job, method=endpoint["method"], endpoint=endpoint["endpoint"],
+                                 direction=direction)
+                lines.append(f'cyber_controller_request_bytes_total{labels} {endpoint["bytes_" + direction]}')
+
+        lines += [
+            '# HELP cyber_controller_request_duration_seconds Latency of the requests.',
+            '# TYPE cyber_controller_request_duration_seconds summary',
+        ]
+        for endpoint in report["endpoints"]:
+            labels = dict(job=job, method=endpoint["method"], endpoint=endpoint["endpoint"])
+            for quantile in QUANTILES:
+                value = endpoint[f"p{int(quantile * 100)}"]
+                lines.append(f'cyber_controller_request_duration_seconds{_labels(**labels, quantile=quantile)}'
+                             f' {value:.6f}')
+            lines.append(f'cyber_controller_request_duration_seconds_sum{_labels(**labels)}'
+                         f' {endpoint["seconds_total"]:.6f}')
+            lines.append(f'cyber_controller_request_duration_seconds_count{_labels(**labels)} {endpoint["count"]}')
+
+        lines += [
+            '# HELP cyber_controller_phase_seconds Wall time of each phase of the run.',
+            '# TYPE cyber_controller_phase_seconds gauge',
+        ]
+        for name, phase in report["phases"].items():
+            lines.append(f'cyber_controller_phase_seconds{_labels(job=job, phase=name)} {phase["seconds"]:.6f}')
+
+        lines += [
+            '# HELP cyber_controller_run_seconds Wall time of the run.',
+            '# TYPE cyber_controller_run_seconds gauge',
+            f'cyber_controller_run_seconds{_labels(job=job)} {report["seconds"]:.6f}',
+            '# HELP cyber_controller_run_timestamp_seconds Start time of the run.',
+            '# TYPE cyber_controller_run_timestamp_seconds gauge',
+            f'cyber_controller_run_timestamp_seconds{_labels(job=job)} {self.started:.0f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, basename):
+        """Write <basename>_metrics.json and <basename>.prom. Returns the two file names.
+
+        The Prometheus file is written to a temporary file and renamed, so a
+        node_exporter textfile collector never reads half of it.
+        """
+        job = os.path.basename(basename)
+        json_file = basename + '_metrics.json'
+        prometheus_file = basename + '.prom'
+        with open(json_file, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+        with open(prometheus_file + '.tmp', 'w') as f:
+            f.write(self.prometheus(job))
+        os.replace(prometheus_file + '.tmp', prometheus_file)
+        return json_file, prometheus_file
+
+
+def write_run_metrics(metrics, log_file):
+    """Write the metrics of a run next to its log file and log a line per endpoint."""
+    json_file, prometheus_file = metrics.write(os.path.splitext(log_file)[0])
+    report = metrics.report()
+    for endpoint in report["endpoints"]:
+        logging.info(f"{endpoint['method']} {endpoint['endpoint']}: {endpoint['count']} requests,"
+                     f" p50 {endpoint['p50']:.3f}s, p95 {endpoint['p95']:.3f}s, p99 {endpoint['p99']:.3f}s")
+    for name, phase in report["phases"].items():
+        logging.info(f"Phase {name}: {phase['seconds']:.2f}s")
+    print(f"Metrics have been written to {json_file} and {prometheus_file}")
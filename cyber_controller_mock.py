@@ -0,0 +1,464 @@
+import json
+import ssl
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter, deque
+from configparser import ConfigParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+SITE_CLASS = "com.radware.insite.model.device.Site"
+DEVICE_CLASS = "com.radware.insite.model.device.Device"
+TREES = ('Physical', 'Organization')
+DEFAULT_PORT = 8080
+SESSION_COOKIE = 'JSESSIONID'
+TREE_PREFIX = '/mgmt/system/config/tree/'
+
+# Endpoints whose behavior can be configured, as named in the mock ini file
+ENDPOINTS = ('login', 'tree', 'site-byname', 'site-byid', 'device-byip',
+             'site-post', 'site-put', 'device-post', 'device-put')
+
+
+class EndpointBehavior:
+    """Latency, error rate and rate limit of one endpoint.
+
+    latency is added to every request, error_rate is the share of the
+    requests answered 500, and rate_limit is the number of requests per
+    second above which the requests are answered 429 (None: no limit).
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._recent = deque()
+
+    def admit(self):
+        """Return False when the request goes over the rate limit."""
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 1.0:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                return False
+            self._recent.append(now)
+            return True
+
+    def fails(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+def device_ip(tree_index, number):
+    """managementIp of a generated device; the trees use different ranges."""
+    return f"10.{tree_index * 100 + number // 62500}.{number // 250 % 250}.{number % 250 + 1}"
+
+
+def device_access(ip):
+    """deviceAccess of a generated device, as the controller returns it."""
+    return {
+        "managementIp": ip,
+        "cliPort": 22,
+        "cliUsername": "radware",
+        "cliPassword": "radware",
+        "httpUsername": "radware",
+        "httpPassword": "radware",
+        "httpsUsername": "radware",
+        "httpsPassword": "radware",
+        "snmpVersion": "SNMP_V3",
+        "snmpV3Username": "radsnmp",
+        "snmpV3AuthenticationProtocol": "SHA",
+        "snmpV3AuthenticationPassword": "radware",
+        "snmpV3PrivacyProtocol": "AES",
+        "snmpV3PrivacyPassword": "radware"
+    }
+
+
+class MockController:
+    """In-memory Cyber-Controller: both trees, the deviceAccess of every device and the sessions.
+
+    Each tree gets the same number of generated sites and devices. The
+    sites form a tree with fanout children per site, and the devices are
+    spread over the root and the sites in turn. Every request is counted
+    per endpoint with its outcome.
+    """
+
+    def __init__(self, devices=0, sites=None, fanout=3, behaviors=None, username=None, password=None,
+                 session_seconds=0):
+        self.behaviors = behaviors or {}
+        self.username = username
+        self.password = password
+        self.session_seconds = session_seconds
+        self.stats = {endpoint: Counter() for endpoint in ENDPOINTS}
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self.nodes = {}
+        self.sites_by_name = {}
+        self.devices_by_ip = {}
+        self.access = {}
+        self.roots = {}
+
+        site_count = sites if sites is not None else max(1, devices // 10)
+        for tree_index, tree in enumerate(TREES, 1):
+            self._build_tree(tree_index, tree, site_count, devices, fanout)
+
+    def _node(self, name, orm_id, element_class, parent_id):
+        node = {"name": name, "meIdentifier": {"managedElementClass": element_class, "managedElementID": orm_id}}
+        if element_class == SITE_CLASS:
+            node["children"] = []
+        self.nodes[orm_id] = node
+        if parent_id is not None:
+            self.nodes[parent_id]["children"].append(node)
+        return node
+
+    def _build_tree(self, tree_index, tree, site_count, device_count, fanout):
+        root_id = f"{tree}-root"
+        self.roots[tree] = self._node(tree, root_id, SITE_CLASS, None)
+        self.sites_by_name[tree] = self.roots[tree]
+
+        # Breadth first: the first fanout sites are under the root, then fanout under each site in turn
+        site_ids = []
+        for number in range(site_count):
+            parent_id = root_id if number < fanout else site_ids[number // fanout - 1]
+            site = self._node(f"{tree}-site-{number}", f"{tree}-s{number}", SITE_CLASS, parent_id)
+            self.sites_by_name[site["name"]] = site
+            site_ids.append(site["meIdentifier"]["managedElementID"])
+
+        parents = [root_id] + site_ids
+        for number in range(device_count):
+            ip = device_ip(tree_index, number)
+            device = self._node(f"dp{number % 4 + 1:02d}-{tree}-{number}", f"{tree}-d{number}", DEVICE_CLASS,
+                                parents[number % len(parents)])
+            device["type"] = "DefensePro" if number % 2 else "Alteon"
+            device["managementIp"] = ip
+            self.devices_by_ip[ip] = device
+            self.access[ip] = device_access(ip)
+
+    def behavior(self, endpoint):
+        return self.behaviors.get(endpoint) or self.behaviors.get('default') or EndpointBehavior()
+
+    def count(self, endpoint, status):
+        with self._lock:
+            self.stats[endpoint]['requests'] += 1
+            self.stats[endpoint][str(status)] += 1
+
+    def login(self, body):
+        if self.username is not None and (body.get('username'), body.get('password')) != (self.username,
+                                                                                          self.password):
+            return None
+        session = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[session] = time.monotonic()
+        return session
+
+    def session_valid(self, session):
+        with self._lock:
+            started = self._sessions.get(session)
+        if started is None:
+            return False
+        return not self.session_seconds or time.monotonic() - started < self.session_seconds
+
+    def tree(self, tree):
+        with self._lock:
+            return json.dumps(self.roots[tree])
+
+    def site_response(self, site):
+        return {"name": site["name"], "meIdentifier": dict(site["meIdentifier"])}
+
+    def device_response(self, device):
+        return {
+            "name": device["name"],
+            "type": device["type"],
+            "managementIp": device["managementIp"],
+            "meIdentifier": dict(device["meIdentifier"]),
+            "deviceSetup": {
+                "deviceAccess": dict(self.access[device["managementIp"]],
+                                     ormID=device["meIdentifier"]["managedElementID"] + "-access")
+            }
+        }
+
+    def _parent_site(self, parent_id):
+        parent = self.nodes.get(parent_id)
+        return parent if parent is not None and "children" in parent else None
+
+    def _detach(self, node):
+        for parent in self.nodes.values():
+            if "children" in parent and node in parent["children"]:
+                parent["children"].remove(node)
+                return
+
+    def add_site(self, body):
+        with self._lock:
+            if body.get('name') in self.sites_by_name:
+                return 400, {"status": "error", "message": f"Site with name {body.get('name')} already exists"}
+            if self._parent_site(body.get('parentOrmID')) is None:
+                return 400, {"status": "error", "message": f"No parent site {body.get('parentOrmID')}"}
+            site = self._node(body['name'], uuid.uuid4().hex, SITE_CLASS, body['parentOrmID'])
+            self.sites_by_name[site["name"]] = site
+        return 200, {"status": "ok", "ormID": site["meIdentifier"]["managedElementID"]}
+
+    def update_site(self, body):
+        with self._lock:
+            site = self.nodes.get(body.get('ormID'))
+            if site is None or "children" not in site:
+                return 404, {"status": "error", "message": f"No site {body.get('ormID')}"}
+            if body.get('name') and body['name'] != site["name"]:
+                self.sites_by_name.pop(site["name"], None)
+                site["name"] = body['name']
+                self.sites_by_name[site["name"]] = site
+            parent = self._parent_site(body.get('parentOrmID'))
+            if parent is not None and site not in parent["children"]:
+                self._detach(site)
+                parent["children"].append(site)
+        return 200, {"status": "ok"}
+
+    def add_device(self, body):
+        access = dict((body.get('deviceSetup') or {}).get('deviceAccess') or {})
+        access.pop('ormID', None)
+        ip = access.get('managementIp')
+        with self._lock:
+            if not ip:
+                return 400, {"status": "error", "message": "No managementIp in deviceAccess"}
+            if ip in self.devices_by_ip:
+                return 400, {"status": "error", "message": f"Device with IP {ip} already exists"}
+            if self._parent_site(body.get('parentOrmID')) is None:
+                return 400, {"status": "error", "message": f"No parent site {body.get('parentOrmID')}"}
+            device = self._node(body.get('name'), uuid.uuid4().hex, DEVICE_CLASS, body['parentOrmID'])
+            device["type"] = body.get('type')
+            device["managementIp"] = ip
+            self.devices_by_ip[ip] = device
+            self.access[ip] = access
+        return 200, {"status": "ok", "ormID": device["meIdentifier"]["managedElementID"]}
+
+    def update_device(self, body):
+        access = dict((body.get('deviceSetup') or {}).get('deviceAccess') or {})
+        access.pop('ormID', None)
+        with self._lock:
+            device = self.nodes.get(body.get('ormID'))
+            if device is None or "managementIp" not in device:
+                return 404, {"status": "error", "message": f"No device {body.get('ormID')}"}
+            if body.get('name'):
+                device["name"] = body['name']
+            self.access[device["managementIp"]].update(access)
+        return 200, {"status": "ok"}
+
+    def stats_response(self):
+        with self._lock:
+            endpoints = {endpoint: dict(counts) for endpoint, counts in self.stats.items() if counts}
+        return {"requests": sum(counts['requests'] for counts in endpoints.values()), "endpoints": endpoints}
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one segment, as from a real controller
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+    controller = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, cookie=None):
+        body = (data if isinstance(data, str) else json.dumps(data)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if cookie:
+            self.send_header('Set-Cookie', f'{SESSION_COOKIE}={cookie}; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+    def session(self):
+        for cookie in (self.headers.get('Cookie') or '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+        return None
+
+    def route(self, method):
+        """Return (endpoint, argument) for the request, or (None, None) if it is unknown."""
+        path = self.path.split('?', 1)[0]
+        if method == 'POST' and path == '/mgmt/system/user/login':
+            return 'login', None
+        if not path.startswith(TREE_PREFIX):
+            return None, None
+        rest = path[len(TREE_PREFIX):]
+        if method == 'GET':
+            if rest in TREES:
+                return 'tree', rest
+            for endpoint, prefix in (('site-byname', 'site/byname/'), ('site-byid', 'site/byid/'),
+                                     ('device-byip', 'device/byip/')):
+                if rest.startswith(prefix):
+                    return endpoint, unquote(rest[len(prefix):])
+        elif method in ('POST', 'PUT') and rest in ('site', 'device'):
+            return f"{rest}-{method.lower()}", None
+        return None, None
+
+    def handle_request(self, method):
+        body = self.read_body() if method in ('POST', 'PUT') else {}
+        if method == 'GET' and self.path == '/mock/stats':
+            return self.send_json(200, self.controller.stats_response())
+
+        endpoint, argument = self.route(method)
+        if endpoint is None:
+            return self.send_json(404, {"status": "error", "message": f"Unknown request {method} {self.path}"})
+
+        behavior = self.controller.behavior(endpoint)
+        if behavior.latency:
+            time.sleep(behavior.latency)
+        status, data, cookie = self.answer(endpoint, argument, body, behavior)
+        self.controller.count(endpoint, status)
+        self.send_json(status, data, cookie)
+
+    def answer(self, endpoint, argument, body, behavior):
+        if not behavior.admit():
+            return 429, {"status": "error", "message": "Too many requests"}, None
+        if behavior.fails():
+            return 500, {"status": "error", "message": "Injected error"}, None
+
+        controller = self.controller
+        if endpoint == 'login':
+            session = controller.login(body)
+            if session is None:
+                return 401, {"status": "error", "message": "Invalid username or password"}, None
+            return 200, {"status": "ok"}, session
+        if not controller.session_valid(self.session()):
+            return 401, {"status": "error", "message": "Session expired"}, None
+
+        if endpoint == 'tree':
+            return 200, controller.tree(argument), None
+        if endpoint == 'site-byname':
+            site = controller.sites_by_name.get(argument)
+            if site is None:
+                return 200, {"status": "error", "message": f"There is no site with name {argument}"}, None
+            return 200, controller.site_response(site), None
+        if endpoint == 'site-byid':
+            site = controller.nodes.get(argument)
+            if site is None or "children" not in site:
+                return 200, {"status": "error", "message": f"There is no site with id {argument}"}, None
+            return 200, controller.site_response(site), None
+        if endpoint == 'device-byip':
+            device = controller.devices_by_ip.get(argument)
+            if device is None:
+                return 404, {"status": "error", "message": f"There is no device with IP {argument}"}, None
+            return 200, controller.device_response(device), None
+
+        handlers = {'site-post': controller.add_site, 'site-put': controller.update_site,
+                    'device-post': controller.add_device, 'device-put': controller.update_device}
+        status, data = handlers[endpoint](body)
+        return status, data, None
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+def load_behaviors(filename, latency=0.0, error_rate=0.0, rate_limit=None):
+    """Read the per-endpoint behaviors of a mock ini file.
+
+    The command line values are the defaults; a [default] section
+    overrides them for every endpoint, and a section named after an
+    endpoint (see ENDPOINTS) for that endpoint only. The login only fails
+    when its own section sets an error-rate.
+    """
+    config = ConfigParser()
+    if filename:
+        config.read(filename)
+
+    def read(section, fallback):
+        values = config[section] if config.has_section(section) else {}
+        rate = values.get('rate-limit')
+        return EndpointBehavior(float(values.get('latency', fallback.latency)),
+                                float(values.get('error-rate', fallback.error_rate)),
+                                float(rate) if rate else fallback.rate_limit)
+
+    default = read('default', EndpointBehavior(latency, error_rate, rate_limit))
+    behaviors = {'default': default}
+    for endpoint in ENDPOINTS:
+        behaviors[endpoint] = read(endpoint, default)
+    if not config.has_option('login', 'error-rate'):
+        # The scripts stop when the login fails, only fail it when asked for explicitly
+        behaviors['login'].error_rate = 0.0
+    unknown = set(config.sections()) - set(ENDPOINTS) - {'default'}
+    if unknown:
+        print(f"Warning: Unknown endpoint(s) in {filename}: {', '.join(sorted(unknown))}")
+    return behaviors
+
+
+def create_server(controller, host='127.0.0.1', port=DEFAULT_PORT, certfile=None, keyfile=None):
+    """Return a server for the controller; https when a certificate is given."""
+    handler = type('Handler', (MockRequestHandler,), {'controller': controller})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Run a local mock Cyber-Controller for tests and benchmarks')
+    parser.add_argument('-n', '--devices', type=int, default=100, help='Devices in each tree (default: 100)')
+    parser.add_argument('--sites', type=int, default=None,
+                        help='Sites in each tree (default: one for every 10 devices)')
+    parser.add_argument('--fanout', type=int, default=3, help='Child sites of each site (default: 3)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help=f'Port (default: {DEFAULT_PORT})')
+    parser.add_argument('--cert', default=None, help='Certificate file, to serve https instead of http')
+    parser.add_argument('--key', default=None, help='Private key file of the certificate')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Seconds added to every request (default: 0)')
+    parser.add_argument('-e', '--error-rate', type=float, default=0.0,
+                        help='Share of the requests answered 500, 0 to 1 (default: 0)')
+    parser.add_argument('-r', '--rate-limit', type=float, default=None,
+                        help='Requests per second per endpoint above which 429 is answered (default: no limit)')
+    parser.add_argument('-f', '--config', default=None,
+                        help='Ini file with per-endpoint latency, error-rate and rate-limit (see mock.example)')
+    parser.add_argument('--username', default=None, help='Only accept this username (default: any)')
+    parser.add_argument('--password', default=None, help='Password of --username')
+    parser.add_argument('--session-seconds', type=float, default=0,
+                        help='Seconds after which a login session expires (default: never)')
+    args = parser.parse_args()
+    if args.fanout < 1:
+        parser.error('the fanout must be at least 1')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    behaviors = load_behaviors(args.config, args.latency, args.error_rate, args.rate_limit)
+    controller = MockController(args.devices, args.sites, args.fanout, behaviors, args.username, args.password,
+                                args.session_seconds)
+    server = create_server(controller, args.host, args.port, args.cert, args.key)
+    scheme = 'https' if args.cert else 'http'
+    print(f"Mock Cyber-Controller with {args.devices} devices per tree listening on"
+          f" {scheme}://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
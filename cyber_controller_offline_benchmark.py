@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from cyber_controller_benchmark import run_script
+from cyber_controller_generate import generate_export, parse_weights, DEFAULT_CLI_USERS, DEFAULT_SNMP_USERS
+
+DEFAULT_SIZES = '1000,10000,100000'
+EXPORT_FILE = 'cyber_controller_organization.json'
+
+# Rotation rules of the rotate stage: one exact, one wildcard and one regex old-user
+CLI_RULES = ("[exact]\nold-user = radware\nnew-user = radware-new\npassword = rotated\n\n"
+             "[wildcard]\nold-user = ops*\nnew-user = ops\npassword = rotated\n")
+SNMP_RULES = ("[regex]\nold-user = re:radsnmp[0-9]*\nnew-user = snmp-new\n"
+              "auth-password = rotated\nprivacy-password = rotated\n")
+
+# Offline stages: name, script, arguments, files written before the run
+STAGES = [
+    ('filter', 'cyber_controller_sites.py', ['-t'], {}),
+    ('split', 'cyber_conytroller_split.py', ['-s', EXPORT_FILE, '-d', 'split'], {}),
+    ('rotate', 'update_json_credentials.py', [], {'clicredentials.ini': CLI_RULES, 'snmpsecrets.ini': SNMP_RULES}),
+]
+
+
+def prepare_filter(directory, fanout, selected):
+    """Put the export and a sites1.ini with the first selected top-level sites in the input directory."""
+    input_dir = os.path.join(directory, 'input')
+    os.makedirs(input_dir, exist_ok=True)
+    shutil.copy(os.path.join(directory, EXPORT_FILE), input_dir)
+    names = [f"Organization-site-{number}" for number in range(min(selected, fanout))]
+    with open(os.path.join(input_dir, 'sites1.ini'), 'w') as f:
+        f.write('sites:\n' + '\n'.join(names) + '\n')
+
+
+def run_size(devices, directory, args):
+    """Generate an export of this size and run every stage on it. Returns one result per stage."""
+    os.makedirs(directory, exist_ok=True)
+    export = os.path.join(directory, EXPORT_FILE)
+    start = time.perf_counter()
+    generate_export(export, 'Organization', devices, args.depth, args.fanout, args.alteon_share,
+                    args.cli_users, args.snmp_users, random.Random(args.seed))
+    export_mb = os.path.getsize(export) / (1024 * 1024)
+    print(f"{'generate':<10}{devices:>9}{time.perf_counter() - start:>10.2f}{'':>12}{'':>10}  {export_mb:.1f} MB",
+          flush=True)
+
+    results = []
+    for name, script, arguments, files in STAGES:
+        if name not in args.stages:
+            continue
+        if name == 'filter':
+            prepare_filter(directory, args.fanout, args.selected_sites)
+        for filename, content in files.items():
+            with open(os.path.join(directory, filename), 'w') as f:
+                f.write(content)
+        returncode, seconds, peak_rss = run_script(script, arguments, directory)
+        results.append({
+            "stage": name,
+            "devices": devices,
+            "export_mb": export_mb,
+            "returncode": returncode,
+            "seconds": seconds,
+            "devices_per_second": devices / seconds if seconds else 0.0,
+            "peak_rss_mb": peak_rss
+        })
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    peak_rss = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else '-'
+    status = 'ok' if result['returncode'] == 0 else f"exit code {result['returncode']}"
+    print(f"{result['stage']:<10}{result['devices']:>9}{result['seconds']:>10.2f}"
+          f"{result['devices_per_second']:>12.0f}{peak_rss:>10}  {status}", flush=True)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Time the filter, split and rotate tools on generated exports of several sizes')
+    parser.add_argument('-n', '--sizes', default=DEFAULT_SIZES,
+                        help=f'Comma separated numbers of devices (default: {DEFAULT_SIZES})')
+    parser.add_argument('-b', '--stages', default=','.join(name for name, *_ in STAGES),
+                        help='Comma separated stages to run (default: all of them)')
+    parser.add_argument('--depth', type=int, default=3, help='Levels of sites under the root (default: 3)')
+    parser.add_argument('--fanout', type=int, default=5, help='Child sites of each site (default: 5)')
+    parser.add_argument('-a', '--alteon-share', type=float, default=0.5,
+                        help='Share of Alteon devices (default: 0.5)')
+    parser.add_argument('--cli-users', default=DEFAULT_CLI_USERS,
+                        help=f'CLI usernames and their weights (default: {DEFAULT_CLI_USERS})')
+    parser.add_argument('--snmp-users', default=DEFAULT_SNMP_USERS,
+                        help=f'SNMPv3 usernames and their weights (default: {DEFAULT_SNMP_USERS})')
+    parser.add_argument('--selected-sites', type=int, default=2,
+                        help='Top-level sites (with their subtrees) the filter stage keeps (default: 2)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the generated exports (default: 1)')
+    parser.add_argument('-d', '--dir', default=None,
+                        help='Directory for the files of the runs, kept afterwards (default: a temporary one)')
+    parser.add_argument('-o', '--output', default='offline_benchmark.json',
+                        help='JSON file for the results (default: offline_benchmark.json)')
+    args = parser.parse_args()
+    try:
+        args.sizes = [int(size) for size in args.sizes.split(',')]
+        args.cli_users = parse_weights(args.cli_users)
+        args.snmp_users = parse_weights(args.snmp_users)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.depth < 1 or args.fanout < 1:
+        parser.error('the depth and the fanout must be at least 1')
+    args.stages = [name.strip() for name in args.stages.split(',')]
+    unknown = set(args.stages) - {name for name, *_ in STAGES}
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_arguments()
+    base_dir = args.dir or tempfile.mkdtemp(prefix='cyber_controller_offline_benchmark_')
+
+    print(f"{'stage':<10}{'devices':>9}{'seconds':>10}{'devices/s':>12}{'RSS MB':>10}")
+    results = []
+    try:
+        for devices in args.sizes:
+            results += run_size(devices, os.path.join(base_dir, str(devices)), args)
+    finally:
+        if not args.dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({"depth": args.depth, "fanout": args.fanout, "results": results}, f, indent=4)
+    print(f"Results have been written to {args.output}")
+
+    if any(result["returncode"] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
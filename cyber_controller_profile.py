@@ -0,0 +1,207 @@
+import io
+import os
+import time
+import atexit
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+DEFAULT_SORT = 'cumulative'
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 1
+
+# The profiler of the run, None when profiling is off
+_active = None
+
+
+class Profiler:
+    """cProfile, tracemalloc and phase timers of one run.
+
+    Phases are named stretches of the run, they may nest and a phase
+    entered several times adds up. For each phase the wall time, the CPU
+    time and the peak of the memory traced by tracemalloc while it ran are
+    kept. tracemalloc only knows the call sites of the memory still
+    allocated, so a snapshot is taken at the end of every phase and the one
+    holding the most memory is reported, by call site.
+
+    cProfile only follows the thread that started it: the time spent by the
+    request worker threads shows up as waiting in the main thread, and the
+    worker processes of a batch are not profiled.
+    """
+
+    def __init__(self, basename, sort=DEFAULT_SORT):
+        self.basename = basename
+        self.sort = sort
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stack = []
+        self.phases = {}
+        self.peak_bytes = 0
+        self.allocations = None
+        self.allocations_bytes = 0
+        self.allocations_phase = None
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.profile.enable()
+
+    def _peak(self):
+        """Peak traced memory since the last reset, then reset it."""
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        return peak
+
+    @contextmanager
+    def phase(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        # The peak so far belongs to the enclosing phase
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], self._peak())
+        else:
+            self._peak()
+        entry = [name, 0]
+        self._stack.append(entry)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            self._stack.pop()
+            peak = max(entry[1], self._peak())
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            with self._lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0.0, "cpu_seconds": 0.0,
+                                                      "peak_bytes": 0})
+                phase["count"] += 1
+                phase["seconds"] += seconds
+                phase["cpu_seconds"] += cpu_seconds
+                phase["peak_bytes"] = max(phase["peak_bytes"], peak)
+            self._take_snapshot(name)
+
+    def _take_snapshot(self, name):
+        """Keep the top call sites if more memory is allocated now than at the last snapshot kept.
+
+        Only the statistics are kept, not the snapshot, so the snapshots do
+        not add to the memory measured afterwards.
+        """
+        current = tracemalloc.get_traced_memory()[0]
+        if self.allocations is not None and current <= self.allocations_bytes:
+            return
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ])
+        self.allocations = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+        self.allocations_bytes = current
+        self.allocations_phase = name
+        del snapshot
+        # The snapshot itself must not count in the peak of the next phase
+        tracemalloc.reset_peak()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and write the report. Returns the file names."""
+        seconds = time.perf_counter() - self._start
+        peak = max(self.peak_bytes, tracemalloc.get_traced_memory()[1])
+        self._take_snapshot('the run')
+        self.profile.disable()
+        tracemalloc.stop()
+
+        report_file = self.basename + '_profile.txt'
+        stats_file = self.basename + '.pstats'
+        self.profile.dump_stats(stats_file)
+        with open(report_file, 'w') as f:
+            f.write(self.report(seconds, peak))
+        return report_file, stats_file
+
+    def report(self, seconds, peak):
+        lines = [
+            f"Profile of {os.path.basename(self.basename)} started"
+            f" {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}",
+            f"Wall time: {seconds:.2f}s, CPU time: {time.process_time():.2f}s,"
+            f" peak traced memory: {_mb(peak)}",
+            "",
+            "Phases:",
+            f"  {'phase':<24}{'count':>7}{'seconds':>11}{'CPU seconds':>13}{'peak MB':>10}",
+        ]
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"  {name:<24}{phase['count']:>7}{phase['seconds']:>11.3f}"
+                         f"{phase['cpu_seconds']:>13.3f}{phase['peak_bytes'] / (1024 * 1024):>10.1f}")
+
+        lines += [
+            "",
+            f"Top {TOP_ALLOCATIONS} allocations by call site ({_mb(self.allocations_bytes)} traced"
+            f" at the end of {self.allocations_phase}):",
+        ]
+        for stat in self.allocations:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / (1024 * 1024):>9.2f} MB {stat.count:>9} blocks"
+                         f"  {frame.filename}:{frame.lineno}")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats(self.sort).print_stats(TOP_FUNCTIONS)
+        lines += [
+            "",
+            f"CPU profile of the main thread, top {TOP_FUNCTIONS} by {self.sort}"
+            f" (all of it in {self.basename}.pstats, python -m pstats to sort it by another key):",
+            stream.getvalue().strip('\n'),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def _mb(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile', nargs='?', const=DEFAULT_SORT, default=None, choices=SORT_KEYS,
+                        metavar='SORT',
+                        help=f'Profile the run (CPU, memory by call site, phase timers) and write a report'
+                             f' sorted by {", ".join(SORT_KEYS)} (default: {DEFAULT_SORT})')
+
+
+def start_profiling(basename, sort=DEFAULT_SORT):
+    """Profile the rest of the run and write <basename>_profile.txt and <basename>.pstats when it exits.
+
+    Does nothing when sort is None (no --profile).
+    """
+    global _active
+    if not sort or _active is not None:
+        return _active
+    _active = Profiler(basename, sort)
+    atexit.register(_stop_profiling)
+    _active.start()
+    return _active
+
+
+def _stop_profiling():
+    global _active
+    profiler, _active = _active, None
+    report_file, stats_file = profiler.stop()
+    logging.info(f"Profile has been written to {report_file} and {stats_file}")
+    print(f"Profile has been written to {report_file} and {stats_file}")
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the run when profiling is on, otherwise do nothing."""
+    if _active is None:
+        yield
+    else:
+        with _active.phase(name):
+            yield
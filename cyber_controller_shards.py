@@ -0,0 +1,289 @@
+import json
+import os
+import sys
+import math
+import heapq
+import time
+import argparse
+import logging
+import subprocess
+from collections import Counter
+from cyber_controller_inventory import Inventory
+from cyber_controller_db import load_tree, DEFAULT_DB_FILE
+
+# Set up logging
+current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
+log = current_working_directory + 'shard_cybercontroller.log'
+logging.basicConfig(filename=log, filemode='w', format='%(asctime)s - %(message)s',
+                    level=logging.INFO)
+
+TREES = ('physical', 'organization')
+SHARED_DIR = 'shared'
+UPLOAD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_cybercontroller_objects.py')
+REPORT_FILE = 'upload_report.json'
+WORKER_OUTPUT_FILE = 'upload_output.txt'
+# Environment variable the upload script reads its credentials file from (CONFIG_FILE_VARIABLE there)
+UPLOAD_CONFIG_VARIABLE = 'CYBER_CONTROLLER_UPLOAD_INI'
+
+
+def site_ancestors(inventory, site_id, cache):
+    """Return the ids of a site and of all its ancestors in the export (the root excluded)."""
+    if site_id in cache:
+        return cache[site_id]
+    path = []
+    seen = set()
+    current = inventory.site_by_id(site_id)
+    while current is not None and current['id'] not in cache and current['id'] not in seen:
+        path.append(current['id'])
+        seen.add(current['id'])
+        current = inventory.site_by_id(current.get('parentOrmID'))
+    ancestors = cache[current['id']] if current is not None and current['id'] in cache else frozenset()
+    # Fill the cache from the top of the path down
+    for ancestor_id in reversed(path):
+        ancestors = ancestors | {ancestor_id}
+        cache[ancestor_id] = ancestors
+    return cache.get(site_id, frozenset())
+
+
+def plan_tree(data, shard_count):
+    """Cut one tree export into shard_count exports with about the same number of devices.
+
+    The devices of a site are placed together, biggest sites first, on the
+    least loaded shard; a site is only cut when its devices don't fit in
+    that shard's share, so no shard gets more than its share. Every shard
+    carries the ancestor sites its devices need, so it can be uploaded on
+    its own. Returns (shards, shared): shared is an
+    export with only the sites that more than one shard needs, or that no
+    shard needs (sites without devices), to be created before the shards.
+    """
+    inventory = Inventory(data)
+    share = max(1, math.ceil(len(inventory.devices) / shard_count))
+
+    groups = sorted(inventory.devices_by_parent.values(), key=len, reverse=True)
+
+    shard_devices = [[] for _ in range(shard_count)]
+    loads = [(0, index) for index in range(shard_count)]
+    for group in groups:
+        while group:
+            # The least loaded shard always has room: the shares add up to at least all the devices
+            load, index = heapq.heappop(loads)
+            placed = group[:share - load]
+            group = group[share - load:]
+            shard_devices[index].extend(placed)
+            heapq.heappush(loads, (load + len(placed), index))
+
+    # Keep the export order inside each shard
+    position = {id(device): index for index, device in enumerate(inventory.devices)}
+    cache = {}
+    shard_site_ids = []
+    users = Counter()
+    for devices in shard_devices:
+        devices.sort(key=lambda device: position[id(device)])
+        site_ids = set()
+        for parent_id in {device.get('parentOrmID') for device in devices}:
+            site_ids |= site_ancestors(inventory, parent_id, cache)
+        shard_site_ids.append(site_ids)
+        users.update(site_ids)
+
+    shared_ids = set()
+    for site in inventory.sites:
+        if users[site['id']] != 1:
+            shared_ids |= site_ancestors(inventory, site['id'], cache)
+
+    shards = [{"sites": [site for site in inventory.sites if site['id'] in site_ids], "devices": devices}
+              for site_ids, devices in zip(shard_site_ids, shard_devices)]
+    shared = {"sites": [site for site in inventory.sites if site['id'] in shared_ids], "devices": []}
+    return shards, shared
+
+
+def load_export(source, tree):
+    """Load one tree from the exported JSON files, or from an SQLite database."""
+    if source:
+        return load_tree(source, tree)
+    filename = f'cyber_controller_{tree}.json'
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logging.error(f"File not found: {filename}")
+        print(f"Error: Could not find file {filename}")
+        return None
+    except json.JSONDecodeError:
+        logging.error(f"Error decoding JSON from file: {filename}")
+        print(f"Error: Invalid JSON format in file {filename}")
+        return None
+
+
+def write_plan(source, shard_count, plan_dir):
+    """Plan both trees and write one upload directory per shard, plus the shared one.
+
+    Returns the list of shard directories, or None if no tree could be loaded.
+    """
+    shard_dirs = [os.path.join(plan_dir, f'shard_{index + 1}') for index in range(shard_count)]
+    shared_dir = os.path.join(plan_dir, SHARED_DIR)
+    for directory in [shared_dir] + shard_dirs:
+        os.makedirs(directory, exist_ok=True)
+
+    plan = {"shards": shard_count, "trees": {}}
+    for tree in TREES:
+        data = load_export(source, tree)
+        if not data:
+            continue
+        shards, shared = plan_tree(data, shard_count)
+        with open(os.path.join(shared_dir, f'cyber_controller_{tree}.json'), 'w') as f:
+            json.dump(shared, f, indent=4)
+        for shard_dir, shard in zip(shard_dirs, shards):
+            with open(os.path.join(shard_dir, f'cyber_controller_{tree}.json'), 'w') as f:
+                json.dump(shard, f, indent=4)
+
+        plan["trees"][tree] = {
+            "shared_sites": len(shared["sites"]),
+            "shards": [{"sites": len(shard["sites"]), "devices": len(shard["devices"])} for shard in shards]
+        }
+        device_counts = ', '.join(str(len(shard["devices"])) for shard in shards)
+        print(f"{tree}: {len(shared['sites'])} shared sites, devices per shard: {device_counts}")
+        logging.info(f"Planned {tree} tree: {len(shared['sites'])} shared sites, devices per shard: {device_counts}")
+
+    if not plan["trees"]:
+        return None
+    with open(os.path.join(plan_dir, 'plan.json'), 'w') as f:
+        json.dump(plan, f, indent=4)
+    print(f"Plan has been written to {plan_dir}")
+    return shard_dirs
+
+
+def start_upload(directory, upload_arguments):
+    """Start the upload script in a shard directory; its output goes to a file there."""
+    # The upload reads the credentials from our upload.ini, no copy of the password is written
+    environment = dict(os.environ, **{UPLOAD_CONFIG_VARIABLE: os.path.abspath('upload.ini')})
+    for leftover in (REPORT_FILE, 'upload.ini'):
+        # upload.ini: the copy an earlier version left behind
+        if os.path.exists(os.path.join(directory, leftover)):
+            os.remove(os.path.join(directory, leftover))
+    output = open(os.path.join(directory, WORKER_OUTPUT_FILE), 'w')
+    process = subprocess.Popen([sys.executable, UPLOAD_SCRIPT, '--report', REPORT_FILE] + upload_arguments,
+                               cwd=directory, env=environment, stdout=output, stderr=subprocess.STDOUT,
+                               stdin=subprocess.DEVNULL)
+    return process, output
+
+
+def finish_upload(directory, process, output, start):
+    """Wait for an upload worker and return its report."""
+    returncode = process.wait()
+    output.close()
+
+    report = {"worker": os.path.basename(directory), "returncode": returncode,
+              "seconds": time.perf_counter() - start, "trees": {}}
+    try:
+        with open(os.path.join(directory, REPORT_FILE), 'r') as f:
+            report["trees"] = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"No report from worker {directory}: {str(e)}")
+    return report
+
+
+def run_plan(plan_dir, shard_dirs, upload_arguments):
+    """Upload the shared sites, then all the shards in parallel, and merge the reports."""
+    reports = []
+
+    # The sites several shards need are created once, before the shards, so no
+    # two workers try to create the same site
+    print("\nUploading shared sites...")
+    shared_dir = os.path.join(plan_dir, SHARED_DIR)
+    start = time.perf_counter()
+    reports.append(finish_upload(shared_dir, *start_upload(shared_dir, upload_arguments), start))
+    if reports[0]["returncode"] != 0:
+        print(f"Upload of the shared sites failed, see {os.path.join(shared_dir, WORKER_OUTPUT_FILE)}")
+        logging.error("Upload of the shared sites failed, the shards were not started")
+        return reports
+
+    print(f"Uploading {len(shard_dirs)} shards in parallel...")
+    start = time.perf_counter()
+    workers = [(shard_dir, start_upload(shard_dir, upload_arguments)) for shard_dir in shard_dirs]
+    for shard_dir, (process, output) in workers:
+        report = finish_upload(shard_dir, process, output, start)
+        status = "done" if report["returncode"] == 0 else f"failed (exit code {report['returncode']})"
+        print(f"{report['worker']}: {status} in {report['seconds']:.1f}s")
+        reports.append(report)
+    return reports
+
+
+def merge_reports(reports):
+    """Sum the outcome counts of all the workers, per tree."""
+    merged = {}
+    for report in reports:
+        for tree, counts in report["trees"].items():
+            merged.setdefault(tree, Counter()).update(counts)
+    return merged
+
+
+def print_summary(reports, merged):
+    print("\nSummary:")
+    for report in reports:
+        counts = Counter()
+        for tree_counts in report["trees"].values():
+            counts.update(tree_counts)
+        print(f"  {report['worker']}: sites created {counts['sites_created']}, "
+              f"devices added {counts['devices_added']}, failed {counts['sites_failed'] + counts['devices_failed']}, "
+              f"{report['seconds']:.1f}s")
+    for tree, counts in merged.items():
+        details = ', '.join(f"{key} {value}" for key, value in sorted(counts.items()))
+        print(f"{tree}: {details}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Split an upload into balanced shards and upload them in parallel')
+    parser.add_argument('-n', '--shards', type=int, required=True, help='Number of shards (parallel upload workers)')
+    parser.add_argument('-d', '--dir', default='shards', help='Directory of the plan (default: shards)')
+    parser.add_argument('-s', '--sqlite', nargs='?', const=DEFAULT_DB_FILE, default=None, metavar='DB',
+                        help=f'Read both trees from an SQLite database instead of the JSON files'
+                             f' (default file: {DEFAULT_DB_FILE})')
+    parser.add_argument('-p', '--plan-only', action='store_true', help='Only write the plan, do not upload')
+    parser.add_argument('-c', '--concurrency', type=int, default=None,
+                        help='Number of parallel requests of each worker (default: the upload default)')
+    parser.add_argument('-a', '--async-devices', action='store_true',
+                        help='Workers submit all devices without waiting for each one (see the upload script)')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Workers skip the objects an interrupted run of the same plan already created')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('the number of shards must be at least 1')
+    return args
+
+
+def main():
+    logging.info('Starting the script.')
+    args = parse_arguments()
+
+    if not args.plan_only and not os.path.exists('upload.ini'):
+        # The workers run without a console, they can't ask for credentials
+        print("Error: upload.ini is required to run the upload workers")
+        return
+
+    shard_dirs = write_plan(args.sqlite, args.shards, args.dir)
+    if not shard_dirs or args.plan_only:
+        return
+
+    upload_arguments = []
+    if args.concurrency:
+        upload_arguments += ['-c', str(args.concurrency)]
+    if args.async_devices:
+        upload_arguments.append('-a')
+    if args.resume:
+        upload_arguments.append('-r')
+
+    reports = run_plan(args.dir, shard_dirs, upload_arguments)
+    merged = merge_reports(reports)
+    print_summary(reports, merged)
+
+    report_file = os.path.join(args.dir, 'report.json')
+    with open(report_file, 'w') as f:
+        json.dump({"workers": reports, "trees": merged}, f, indent=4)
+    print(f"Report has been written to {report_file}")
+
+    logging.info('Finishing the script.')
+    print("\nDone.")
+
+
+if __name__ == "__main__":
+    main()
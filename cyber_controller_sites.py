@@ -1,51 +1,226 @@
-import json
 import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob
+from collections import Counter
+from cyber_controller_stream import iter_export_records, JsonExportWriter
+from cyber_controller_db import is_sqlite, iter_db_records
+from cyber_controller_profile import add_profile_argument, start_profiling, phase
 
-def filter_json_by_sites(json_data, site_names):
-    # Filter sites section
-    filtered_sites = [site for site in json_data.get('sites', []) if site.get('name') in site_names]
+def read_site_names(sites_file_path):
+    """Return the site names listed in a sites*.ini file."""
+    with open(sites_file_path, 'r') as f:
+        sites_content = f.read()
     
-    # Get the IDs of the filtered sites
-    filtered_site_ids = [site.get('id') for site in filtered_sites]
+    # Parse sites from the file
+    sites_lines = sites_content.strip().split('\n')
+    if len(sites_lines) > 0 and sites_lines[0].startswith('sites:'):
+        sites_lines = sites_lines[1:]
     
-    # Filter devices section based on parentOrmID
-    filtered_devices = [device for device in json_data.get('devices', []) 
-                        if device.get('parentOrmID') in filtered_site_ids]
+    # Clean up site names (remove commas and whitespace)
+    return [site.strip(' ,') for site in sites_lines]
+
+def sites_parents_first(sites):
+    """Return the sites ordered so that every site comes after its parent.
+    
+    Uses a parent -> children index built once; sites caught in a
+    parentOrmID cycle are added at the end.
+    """
+    site_ids = {site.get('id') for site in sites}
+    children = {}
+    for site in sites:
+        children.setdefault(site.get('parentOrmID'), []).append(site)
+    
+    ordered = []
+    visited = set()
+    stack = [site for site in reversed(sites) if site.get('parentOrmID') not in site_ids]
+    while stack:
+        site = stack.pop()
+        if id(site) in visited:
+            continue
+        visited.add(id(site))
+        ordered.append(site)
+        stack.extend(reversed(children.get(site.get('id'), [])))
+    ordered.extend(site for site in sites if id(site) not in visited)
+    return ordered
+
+def filter_json_by_sites(records, outputs, subtree=False):
+    """Write the records of an export to the outputs that select them.
+    
+    outputs is a list of (site_names, writer) pairs. A site goes to every
+    output that lists its name and a device to every output that holds its
+    parent site. With subtree, a site also goes to every output that holds
+    its parent site, so each listed site brings its whole subtree.
     
-    # Create the filtered data
-    filtered_data = {
-        'sites': filtered_sites,
-        'devices': filtered_devices
-    }
+    The records are read in a single pass for all the outputs. The sites
+    read before the first device (all of them in a JSON export) are
+    resolved together, parents first; a site that comes later (NDJSON)
+    follows its parent, which a tree walk always writes before it.
+    """
+    # Site name -> writers that keep it
+    writers_by_name = {}
+    for site_names, writer in outputs:
+        for site_name in set(site_names):
+            writers_by_name.setdefault(site_name, []).append(writer)
+    
+    # Site id -> writers of the selected sites seen so far
+    writers_by_site_id = {}
+    
+    def site_writers(site):
+        writers = writers_by_name.get(site.get('name'), [])
+        if subtree:
+            # dict.fromkeys() merges the two lists without duplicates, in order
+            writers = list(dict.fromkeys(writers + writers_by_site_id.get(site.get('parentOrmID'), [])))
+        if writers:
+            writers_by_site_id[site.get('id')] = writers
+        return writers
+    
+    def write_sites(sites):
+        selected = {id(site): site_writers(site) for site in sites_parents_first(sites)}
+        for site in sites:
+            for writer in selected[id(site)]:
+                writer.write("site", site)
+    
+    pending_sites = []
+    for kind, record in records:
+        if kind == "site":
+            if pending_sites is not None:
+                pending_sites.append(record)
+                continue
+            writers = site_writers(record)
+        else:
+            if pending_sites is not None:
+                write_sites(pending_sites)
+                pending_sites = None
+            writers = writers_by_site_id.get(record.get('parentOrmID'), ())
+        for writer in writers:
+            writer.write(kind, record)
+    if pending_sites is not None:
+        write_sites(pending_sites)
+
+def output_base(json_file_path, keep_extension=False):
+    """Return the base name of the filtered files of an export.
     
-    return filtered_data
+    The extension is dropped, unless keep_extension (then cyber_controller.db
+    gives cyber_controller_db). The sites of a database come from its
+    organization tree, so "_organization" is appended to its name.
+    """
+    name = os.path.basename(json_file_path)
+    base, extension = os.path.splitext(name)
+    if keep_extension:
+        base = base + '_' + extension.lstrip('.')
+    if extension == '.db':
+        base += '_organization'
+    return base
+
+def output_bases(json_files):
+    """Map every export to the base name of its filtered files, unique among them.
+    
+    Exports that would write the same files (cyber_controller.db and
+    cyber_controller_organization.json, or the .json and .ndjson of one
+    tree) keep their extension in the name.
+    """
+    counts = Counter(output_base(json_file_path) for json_file_path in json_files)
+    return {json_file_path: output_base(json_file_path, counts[output_base(json_file_path)] > 1)
+            for json_file_path in json_files}
+
+def filter_export(json_file_path, selections, subtree=False, json_file_base=None):
+    """Write the filtered file of every selection from a single read of one export.
+    
+    selections is a list of (sites_file_name, sites_number, site_names).
+    The files are named after json_file_base (default: output_base()).
+    Returns a summary of the job: the files written (or the error) and how
+    long it took.
+    """
+    start = time.perf_counter()
+    json_file_base = json_file_base or output_base(json_file_path)
+    result = {'export': json_file_path, 'outputs': [], 'sites': 0, 'devices': 0, 'error': None}
+    
+    writers = []
+    try:
+        from_db = is_sqlite(json_file_path)
+        
+        for sites_file_name, sites_number, site_names in selections:
+            output_file_name = f"./output/{json_file_base}_sites{sites_number}.json"
+            writers.append((site_names, JsonExportWriter(output_file_name)))
+            result['outputs'].append((sites_file_name, output_file_name))
+        
+        if from_db:
+            # Only the selected sites and their devices are read, through the database indexes
+            all_site_names = set().union(*(site_names for site_names, _ in writers))
+            records = iter_db_records(json_file_path, 'organization', site_names=all_site_names,
+                                     subtree=subtree)
+        else:
+            records = iter_export_records(json_file_path)
+        filter_json_by_sites(records, writers, subtree)
+    except Exception as e:
+        for _, writer in writers:
+            writer.discard()
+        result['outputs'] = []
+        result['error'] = str(e)
+    else:
+        for _, writer in writers:
+            writer.close()
+            result['sites'] += writer.counts['site']
+            result['devices'] += writer.counts['device']
+    
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_batch(json_files, selections, subtree=False, workers=None):
+    """Filter every export in its own worker process and print a timing summary."""
+    start = time.perf_counter()
+    results = []
+    # Two exports writing the same file at once would overwrite (or discard) each other's output
+    bases = output_bases(json_files)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(filter_export, json_file_path, selections, subtree, bases[json_file_path])
+                for json_file_path in json_files]
+        for job in as_completed(jobs):
+            result = job.result()
+            results.append(result)
+            if result['error']:
+                print(f"Error reading {result['export']}: {result['error']}")
+            else:
+                print(f"{result['export']}: {len(result['outputs'])} file(s) written in {result['seconds']:.2f}s")
+    
+    print("\nBatch summary:")
+    for result in sorted(results, key=lambda result: result['export']):
+        if result['error']:
+            print(f"  {os.path.basename(result['export'])}: failed after {result['seconds']:.2f}s")
+        else:
+            print(f"  {os.path.basename(result['export'])}: {len(result['outputs'])} file(s), "
+                  f"{result['sites']} sites, {result['devices']} devices in {result['seconds']:.2f}s")
+    failed = sum(1 for result in results if result['error'])
+    print(f"{len(results)} export(s), {failed} failed, in {time.perf_counter() - start:.2f}s")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Filter the sites listed in ./input/sites*.ini out of an export')
+    parser.add_argument('-t', '--subtree', action='store_true',
+                        help='Also keep the child sites of every listed site, and their devices, down the whole tree')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Filter every export in the input directory, not only the first one, in parallel processes')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes in batch mode (default: number of CPUs)')
+    add_profile_argument(parser)
+    return parser.parse_args()
 
 def main():
+    args = parse_arguments()
+    start_profiling(os.path.abspath('cyber_controller_sites'), args.profile)
+    
     # Create output directory if it doesn't exist
     if not os.path.exists('./output'):
         os.makedirs('./output')
     
-    # Find all JSON files in the input directory
-    json_files = glob.glob('./input/*.json')
+    # Find all JSON (or NDJSON, or SQLite) files in the input directory
+    json_files = glob.glob('./input/*.json') + glob.glob('./input/*.ndjson') + glob.glob('./input/*.db')
     
     if not json_files:
         print("No JSON files found in the input directory")
         return
     
-    # Take the first JSON file as input
-    json_file_path = json_files[0]
-    json_file_name = os.path.basename(json_file_path)
-    json_file_base, json_file_ext = os.path.splitext(json_file_name)
-    
-    # Read the JSON data once
-    try:
-        with open(json_file_path, 'r') as f:
-            json_data = json.load(f)
-    except Exception as e:
-        print(f"Error reading JSON file: {e}")
-        return
-    
     # Find all INI files in the input directory
     ini_files = glob.glob('./input/sites*.ini')
     
@@ -53,7 +228,8 @@ def main():
         print("No site INI files found in the input directory")
         return
     
-    # Process each INI file
+    # Read every INI file first, so each export is read only once for all of them
+    selections = []
     for sites_file_path in ini_files:
         sites_file_name = os.path.basename(sites_file_path)
         
@@ -63,32 +239,27 @@ def main():
             sites_number = sites_file_name[5:-4]  # Extract number between "sites" and ".ini"
         
         try:
-            # Read the sites file
-            with open(sites_file_path, 'r') as f:
-                sites_content = f.read()
-            
-            # Parse sites from the file
-            sites_lines = sites_content.strip().split('\n')
-            if len(sites_lines) > 0 and sites_lines[0].startswith('sites:'):
-                sites_lines = sites_lines[1:]
-            
-            # Clean up site names (remove commas and whitespace)
-            site_names = [site.strip(' ,') for site in sites_lines]
-            
-            # Filter the JSON data
-            filtered_data = filter_json_by_sites(json_data, site_names)
-            
-            # Generate output file name
-            output_file_name = f"./output/{json_file_base}_sites{sites_number}{json_file_ext}"
-            
-            # Write the filtered data to the output file
-            with open(output_file_name, 'w') as f:
-                json.dump(filtered_data, f, indent=4)
-            
-            print(f"Filtered data for {sites_file_name} has been written to '{output_file_name}'")
-            
+            site_names = read_site_names(sites_file_path)
         except Exception as e:
             print(f"Error processing {sites_file_name}: {e}")
+            continue
+        
+        selections.append((sites_file_name, sites_number, site_names))
+    
+    if args.batch:
+        with phase('batch'):
+            run_batch(json_files, selections, args.subtree, args.workers)
+        return
+    
+    # Take the first JSON file as input
+    with phase('filter'):
+        result = filter_export(json_files[0], selections, args.subtree)
+    if result['error']:
+        print(f"Error reading JSON file: {result['error']}")
+        return
+    
+    for sites_file_name, output_file_name in result['outputs']:
+        print(f"Filtered data for {sites_file_name} has been written to '{output_file_name}'")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
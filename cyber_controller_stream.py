@@ -0,0 +1,264 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import argparse
+import logging
+from cyber_controller_db import is_sqlite, iter_db_records
+
+# Size of the blocks read from an export file
+READ_CHUNK_SIZE = 64 * 1024
+
+# Top-level lists of a JSON export and the kind of record each one holds
+EXPORT_LISTS = {"sites": "site", "devices": "device"}
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class NdjsonWriter:
+    """Write export records to a newline-delimited JSON file as they are completed.
+
+    Each line is one object with a "record" field ("site" or "device") and
+    the same fields as in the JSON export, so nothing has to be kept in
+    memory until the end of the download.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'w')
+
+    def write(self, kind, record):
+        self._file.write(json.dumps({"record": kind, **record}) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+def iter_ndjson_records(filename, kind=None):
+    """Yield (kind, record) from an NDJSON export, optionally only one kind."""
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_kind = record.pop("record", None)
+            if kind is None or record_kind == kind:
+                yield record_kind, record
+
+
+class _JsonTokens:
+    """Pull JSON values and punctuation from a file read in chunks.
+
+    Only the unread part of the current chunk is kept, so memory is bounded
+    by the size of the largest single value that is decoded.
+    """
+
+    def __init__(self, f, chunk_size=READ_CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._eof = False
+        self.buffer = ''
+        self.pos = 0
+
+    def _fill(self):
+        """Append the next chunk to the buffer. Returns False at the end of the file."""
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, or '' at the end."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        """Consume the next character, which must be one of characters, and return it."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(f"Expecting one of {characters!r}", self.buffer, self.pos)
+        self.pos += 1
+        return character
+
+    def value(self):
+        """Decode and return the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may continue in the next chunk
+                if self._fill():
+                    continue
+                raise
+            # A number that ends the buffer may have more digits in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_records(filename, kind=None, chunk_size=READ_CHUNK_SIZE):
+    """Yield (kind, record) from a {"sites": [...], "devices": [...]} export, one record at a time.
+
+    The file is read in chunks and each record is decoded on its own, so a
+    large export is never loaded as a whole. Other top-level keys are skipped.
+    """
+    with open(filename, 'r') as f:
+        tokens = _JsonTokens(f, chunk_size)
+        tokens.expect('{')
+        if tokens.peek() == '}':
+            return
+        while True:
+            key = tokens.value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name", tokens.buffer, tokens.pos)
+            tokens.expect(':')
+
+            record_kind = EXPORT_LISTS.get(key)
+            if record_kind is None or tokens.peek() != '[':
+                tokens.value()
+            else:
+                tokens.expect('[')
+                if tokens.peek() == ']':
+                    tokens.expect(']')
+                else:
+                    while True:
+                        record = tokens.value()
+                        if kind is None or kind == record_kind:
+                            yield record_kind, record
+                        if tokens.expect(',]') == ']':
+                            break
+
+            if tokens.expect(',}') == '}':
+                return
+
+
+def is_ndjson(filename):
+    """Tell an NDJSON export from a JSON one by its extension or its first line."""
+    if filename.endswith('.ndjson'):
+        return True
+    with open(filename, 'r') as f:
+        first_line = f.readline(READ_CHUNK_SIZE)
+    try:
+        record = json.loads(first_line)
+    except ValueError:
+        # The first line of a JSON export is just "{"
+        return False
+    return isinstance(record, dict) and "record" in record
+
+
+def iter_export_records(filename, kind=None, tree="organization"):
+    """Yield (kind, record) from a JSON or NDJSON export, one record at a time.
+
+    An SQLite database (see cyber_controller_db.py) is read too; tree picks
+    which of its trees. In every format a device comes after the site that
+    contains it.
+    """
+    if is_sqlite(filename):
+        return iter_db_records(filename, tree, kind)
+    if is_ndjson(filename):
+        return iter_ndjson_records(filename, kind)
+    return iter_json_records(filename, kind)
+
+
+class JsonExportWriter:
+    """Write a {"sites": [...], "devices": [...]} export one record at a time.
+
+    Sites go straight to the file; devices are spooled to a temporary file
+    and appended on close, so records can be written in any order in a
+    single pass. The result is the same as json.dump(..., indent=indent).
+    Used as a context manager, the incomplete file is removed when an
+    exception is raised.
+    """
+
+    def __init__(self, filename, indent=4):
+        self.filename = filename
+        self.indent = indent
+        self.counts = {"site": 0, "device": 0}
+        self._file = open(filename, 'w')
+        self._devices = tempfile.TemporaryFile('w+')
+        self._file.write('{\n' + ' ' * indent + '"sites": [')
+
+    def write(self, kind, record):
+        f = self._file if kind == "site" else self._devices
+        f.write(',\n' if self.counts[kind] else '\n')
+        prefix = ' ' * (self.indent * 2)
+        f.write('\n'.join(prefix + line for line in json.dumps(record, indent=self.indent).split('\n')))
+        self.counts[kind] += 1
+
+    def _end_list(self, count):
+        self._file.write('\n' + ' ' * self.indent + ']' if count else ']')
+
+    def close(self):
+        self._end_list(self.counts["site"])
+        self._file.write(',\n' + ' ' * self.indent + '"devices": [')
+        self._devices.seek(0)
+        shutil.copyfileobj(self._devices, self._file)
+        self._end_list(self.counts["device"])
+        self._file.write('\n}')
+        self._devices.close()
+        self._file.close()
+
+    def discard(self):
+        self._devices.close()
+        self._file.close()
+        os.remove(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def ndjson_to_json(ndjson_filename, json_filename):
+    """Convert an NDJSON export to the {"sites": [...], "devices": [...]} JSON layout.
+
+    Only one record is in memory at a time. The output is the same as
+    json.dump(..., indent=4).
+    """
+    with JsonExportWriter(json_filename) as writer:
+        for kind, record in iter_ndjson_records(ndjson_filename):
+            writer.write(kind, record)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Convert NDJSON exports to the Cyber-Controller JSON files')
+    parser.add_argument('files', nargs='*',
+                        default=['cyber_controller_physical.ndjson', 'cyber_controller_organization.ndjson'],
+                        help='NDJSON files to convert (default: the physical and organization exports)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for ndjson_filename in args.files:
+        if not os.path.exists(ndjson_filename):
+            print(f"Error: Could not find file {ndjson_filename}")
+            continue
+        json_filename = os.path.splitext(ndjson_filename)[0] + '.json'
+        try:
+            ndjson_to_json(ndjson_filename, json_filename)
+            print(f'Data has been written to {json_filename}')
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f'Error converting {ndjson_filename}: {str(e)}')
+            print(f'Error converting {ndjson_filename}: {str(e)}')
+
+
+if __name__ == "__main__":
+    main()
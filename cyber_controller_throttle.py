@@ -0,0 +1,154 @@
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Responses that mean the controller is overloaded; the request is retried
+OVERLOAD_STATUS_CODES = (429, 500, 502, 503, 504)
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+# A request slower than this many times the fastest one seen counts as congestion
+LATENCY_TOLERANCE = 3.0
+
+
+class RateLimiter:
+    """Hard cap on the number of requests started per second, shared by all workers."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_start = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of requests in flight.
+
+    Each successful request raises the limit by 1/limit (about +1 per round
+    trip). A 429/5xx, a timeout or a request much slower than the fastest
+    seen halves it, at most once per round trip so a burst of errors from
+    the same window only counts once.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(initial if initial else max(self.minimum, self.maximum // 2))
+        self.in_flight = 0
+        self.min_latency = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, latency):
+        with self._condition:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            if latency > self.min_latency * LATENCY_TOLERANCE:
+                self._decrease(latency)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def on_overload(self, latency):
+        with self._condition:
+            self._decrease(latency)
+
+    def _decrease(self, latency):
+        now = time.monotonic()
+        if now - self._last_decrease < latency:
+            return
+        self._last_decrease = now
+        old_limit = int(self.limit)
+        self.limit = max(self.minimum, self.limit / 2)
+        if int(self.limit) != old_limit:
+            logging.info(f"Controller is slowing down, parallel requests reduced to {int(self.limit)}")
+
+
+def _run_with_retries(item, send, limiter, rate_limiter, retries):
+    response = None
+    error = None
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.wait()
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = send(item)
+            error = None
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            response = None
+            error = e
+        except Exception as e:
+            limiter.release()
+            return item, None, e
+        latency = time.monotonic() - start
+        limiter.release()
+
+        if response is not None and response.status_code not in OVERLOAD_STATUS_CODES:
+            limiter.on_success(latency)
+            break
+        limiter.on_overload(latency)
+        if attempt < retries:
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+    return item, response, error
+
+
+def iter_adaptive(items, send, limiter, rate_limiter=None, retries=DEFAULT_RETRIES):
+    """Yield (item, response, error) for every item, in order, as the requests complete.
+
+    Same as run_adaptive(), but items is consumed lazily: only a window of
+    twice the limiter's maximum is pending at a time. items can itself be
+    a generator fed by another stage, so the requests of both stages
+    overlap; stages that share a rate_limiter are capped together. When
+    the iteration stops early, the requests not started yet are cancelled.
+    """
+    window = deque()
+    with ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        try:
+            for item in items:
+                window.append(executor.submit(_run_with_retries, item, send, limiter, rate_limiter, retries))
+                if len(window) >= limiter.maximum * 2:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            # Interrupted (Ctrl-C) or abandoned by the caller: the requests that
+            # have not started are dropped, only the ones in flight complete
+            for future in window:
+                future.cancel()
+
+
+def run_adaptive(items, send, max_concurrency, rate=None, retries=DEFAULT_RETRIES):
+    """Call send(item) for every item, as many in flight as the controller absorbs.
+
+    send() performs one HTTP request and returns its response. The number of
+    requests in flight starts at half of max_concurrency and adapts (AIMD)
+    between 1 and max_concurrency; rate is an optional hard cap on requests
+    per second.
+    Overloaded (429/5xx) and timed out requests are retried up to retries
+    times. Returns one (item, response, error) tuple per item, in the order
+    of the items; error is the last exception when no response was received.
+    """
+    limiter = AdaptiveLimiter(max_concurrency)
+    rate_limiter = RateLimiter(rate) if rate else None
+    return list(iter_adaptive(items, send, limiter, rate_limiter, retries))
@@ -1,7 +1,13 @@
 import json
+import re
+import bisect
+import ipaddress
 import argparse
 import os
 import logging
+from configparser import ConfigParser, Error as ConfigParserError
+from cyber_controller_stream import iter_export_records, JsonExportWriter
+from cyber_controller_profile import add_profile_argument, start_profiling, phase
 
 # Set up logging
 current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
@@ -22,97 +28,289 @@ def ensure_output_dir(dir_path):
             return False
     return True
 
-def load_json_file(filename):
-    """Load a JSON file and return its contents."""
+def split_values(value):
+    """Split a rule value on commas and new lines."""
+    return [item.strip() for item in re.split(r'[,\n]', value) if item.strip()]
+
+class SplitRule:
+    """One output file of the split and the devices that go to it.
+    
+    A device matches when it matches every kind of criteria the rule has,
+    and any one value of each kind. A rule without criteria takes every
+    device that no earlier rule took.
+    """
+    
+    def __init__(self, name, filename, prefixes=(), patterns=(), types=(), subnets=(), sites=()):
+        self.name = name
+        self.filename = filename
+        self.prefixes = [prefix.lower() for prefix in prefixes]
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.types = [device_type.lower() for device_type in types]
+        self.subnets = [ipaddress.ip_network(subnet, strict=False) for subnet in subnets]
+        self.sites = list(sites)
+    
+    def describe(self):
+        criteria = [
+            ('prefix', self.prefixes),
+            ('regex', [pattern.pattern for pattern in self.patterns]),
+            ('type', self.types),
+            ('subnet', [str(subnet) for subnet in self.subnets]),
+            ('site', self.sites),
+        ]
+        return '; '.join(f"{key} {', '.join(values)}" for key, values in criteria if values) or 'all other devices'
+
+def load_rules(filename):
+    """Load the split rules from an INI file, one section per output file.
+    
+    Keys of a section (all optional): file (default <section>.json),
+    prefix, type, subnet and site (lists separated by commas or new lines)
+    and regex (one pattern per line). Returns None when the file can't be used.
+    """
+    # No interpolation, so regular expressions can use '%'
+    config = ConfigParser(interpolation=None)
     try:
-        with open(filename, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        logging.error(f"File not found: {filename}")
-        print(f"Error: Could not find file {filename}")
+        if not config.read(filename):
+            logging.error(f"File not found: {filename}")
+            print(f"Error: Could not find file {filename}")
+            return None
+        
+        rules = []
+        for section in config.sections():
+            values = config[section]
+            rules.append(SplitRule(
+                section,
+                values.get('file', f"{section}.json"),
+                prefixes=split_values(values.get('prefix', '')),
+                patterns=[line.strip() for line in values.get('regex', '').split('\n') if line.strip()],
+                types=split_values(values.get('type', '')),
+                subnets=split_values(values.get('subnet', '')),
+                sites=split_values(values.get('site', ''))))
+    except (ConfigParserError, re.error, ValueError) as e:
+        logging.error(f"Error in rule file {filename}: {str(e)}")
+        print(f"Error in rule file {filename}: {str(e)}")
         return None
-    except json.JSONDecodeError:
-        logging.error(f"Error decoding JSON from file: {filename}")
-        print(f"Error: Invalid JSON format in file {filename}")
+    
+    if not rules:
+        logging.error(f"No rules in file: {filename}")
+        print(f"Error: No rules in file {filename}")
         return None
+    return rules
 
-def save_json_file(data, filename):
-    """Save data to a JSON file."""
-    try:
-        # Ensure parent directory exists
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
+class PrefixTrie:
+    """Character trie of name prefixes; a lookup walks the name once."""
+    
+    def __init__(self):
+        self._root = {}
+    
+    def add(self, prefix, value):
+        node = self._root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node.setdefault(None, []).append(value)
+    
+    def lookup(self, name):
+        """Return the values of every prefix of name."""
+        found = list(self._root.get(None, []))
+        node = self._root
+        for character in name:
+            node = node.get(character)
+            if node is None:
+                break
+            found.extend(node.get(None, []))
+        return found
+
+class SubnetIndex:
+    """Subnets cut into sorted, non-overlapping address intervals.
+    
+    Each interval holds the values of every subnet that covers it, so a
+    lookup is one binary search, even with overlapping subnets.
+    """
+    
+    def __init__(self):
+        self._subnets = []
+        self._starts = {}
+        self._values = {}
+    
+    def add(self, subnet, value):
+        self._subnets.append((subnet, value))
+    
+    def build(self):
+        for version in (4, 6):
+            subnets = [(int(subnet.network_address), int(subnet.broadcast_address), value)
+                       for subnet, value in self._subnets if subnet.version == version]
+            starts = sorted({first for first, _, _ in subnets} | {last + 1 for _, last, _ in subnets})
+            self._starts[version] = starts
+            self._values[version] = [[value for first, last, value in subnets if first <= start <= last]
+                                     for start in starts]
+    
+    def lookup(self, address):
+        """Return the values of every subnet that contains address."""
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return []
+        starts = self._starts.get(address.version, [])
+        position = bisect.bisect_right(starts, int(address)) - 1
+        return self._values[address.version][position] if position >= 0 else []
+
+class DevicePartitioner:
+    """Find the first rule that matches a device, with indexed lookups.
+    
+    Prefixes are looked up in a trie, subnets in an interval index and
+    types and parent sites in dictionaries, so a device costs one walk of
+    its name and a few lookups, whatever the number of rules. Regular
+    expressions are only tried for the rules those lookups leave as
+    candidates.
+    """
+    
+    def __init__(self, rules):
+        self.rules = rules
+        self._prefixes = PrefixTrie()
+        self._subnets = SubnetIndex()
+        self._types = {}
+        self._sites = {}
+        # Rules that no index can find: regex only, or without criteria
+        self._unindexed = set()
         
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=2)
-        print(f"Successfully saved: {filename}")
-        logging.info(f"Successfully saved: {filename}")
-        return True
-    except Exception as e:
-        logging.error(f"Error saving file {filename}: {str(e)}")
-        print(f"Error saving file {filename}: {str(e)}")
-        return False
+        for index, rule in enumerate(rules):
+            for prefix in rule.prefixes:
+                self._prefixes.add(prefix, index)
+            for subnet in rule.subnets:
+                self._subnets.add(subnet, index)
+            for device_type in rule.types:
+                self._types.setdefault(device_type, set()).add(index)
+            for site in rule.sites:
+                self._sites.setdefault(site, set()).add(index)
+            if not (rule.prefixes or rule.subnets or rule.types or rule.sites):
+                self._unindexed.add(index)
+        self._subnets.build()
+    
+    def match(self, device, site_name):
+        """Return the first rule that takes the device, or None."""
+        name = device.get("name") or ""
+        prefix_hits = set(self._prefixes.lookup(name.lower()))
+        subnet_hits = set(self._subnets.lookup(device.get("managementIp") or ""))
+        type_hits = self._types.get((device.get("type") or "").lower(), set())
+        site_hits = self._sites.get(site_name, set())
+        
+        for index in sorted(prefix_hits | subnet_hits | type_hits | site_hits | self._unindexed):
+            rule = self.rules[index]
+            if rule.prefixes and index not in prefix_hits:
+                continue
+            if rule.subnets and index not in subnet_hits:
+                continue
+            if rule.types and index not in type_hits:
+                continue
+            if rule.sites and index not in site_hits:
+                continue
+            if rule.patterns and not any(pattern.search(name) for pattern in rule.patterns):
+                continue
+            return rule
+        return None
+
+def default_rules(output_file1, output_file2):
+    """The original split: dp01/dp03 devices in one file, dp02/dp04 in the other."""
+    return [
+        SplitRule('file 1', output_file1, prefixes=['dp01', 'dp03']),
+        SplitRule('file 2', output_file2, prefixes=['dp02', 'dp04']),
+    ]
+
+def discard_outputs(writers):
+    """Remove the incomplete output files of a failed split."""
+    for writer in writers.values():
+        writer.discard()
+
+def split_devices(source_json, output_dir, rules, tree="organization"):
+    """Split devices according to the rules.
 
-def split_devices(source_json, output_dir, output_file1, output_file2):
-    """Split devices according to the specified criteria."""
+    The source file (JSON, NDJSON or an SQLite database, of which the given
+    tree is split) is read one record at a time and all the output files
+    are written in the same pass. Every output file gets all the sites; a
+    device goes to the first rule that matches it.
+    """
     logging.info('Starting to split devices.')
     
     # Ensure output directory exists
     if not ensure_output_dir(output_dir):
         return False
     
-    # Create full paths for output files
-    output_path1 = os.path.join(output_dir, output_file1)
-    output_path2 = os.path.join(output_dir, output_file2)
-    
-    # Load the source JSON file
-    data = load_json_file(source_json)
-    if not data:
+    if not os.path.exists(source_json):
+        logging.error(f"File not found: {source_json}")
+        print(f"Error: Could not find file {source_json}")
         return False
     
-    # Create two new data structures with the same sites
-    data1 = {
-        "sites": data.get("sites", []),
-        "devices": []
-    }
-    
-    data2 = {
-        "sites": data.get("sites", []),
-        "devices": []
-    }
-    
-    # Filter devices based on criteria
-    for device in data.get("devices", []):
-        device_name = device.get("name", "").lower()
+    partitioner = DevicePartitioner(rules)
+    site_names = {}
+    total_devices = 0
+    writers = {}
+    try:
+        # Create full paths for output files; rules that share a file share its writer
+        for rule in rules:
+            if rule.filename not in writers:
+                output_file = os.path.join(output_dir, rule.filename)
+                # A rule file may name a file in a subdirectory of the output directory
+                if not ensure_output_dir(os.path.dirname(output_file)):
+                    discard_outputs(writers)
+                    return False
+                writers[rule.filename] = JsonExportWriter(output_file, indent=2)
         
-        if device_name.startswith("dp01") or device_name.startswith("dp03"):
-            data1["devices"].append(device)
-            logging.info(f"Device {device_name} added to file 1")
-        elif device_name.startswith("dp02") or device_name.startswith("dp04"):
-            data2["devices"].append(device)
-            logging.info(f"Device {device_name} added to file 2")
+        for kind, record in iter_export_records(source_json, tree=tree):
+            if kind == "site":
+                # All files get the same sites
+                site_names[record.get('id')] = record.get('name')
+                for writer in writers.values():
+                    writer.write(kind, record)
+                continue
+            
+            # Filter devices based on the rules
+            total_devices += 1
+            rule = partitioner.match(record, site_names.get(record.get('parentOrmID')))
+            if rule:
+                writers[rule.filename].write(kind, record)
+                logging.info(f"Device {record.get('name', '')} added to {rule.filename}")
+    except json.JSONDecodeError:
+        logging.error(f"Error decoding JSON from file: {source_json}")
+        print(f"Error: Invalid JSON format in file {source_json}")
+        discard_outputs(writers)
+        return False
+    except Exception as e:
+        logging.error(f"Error splitting file {source_json}: {str(e)}")
+        print(f"Error splitting file {source_json}: {str(e)}")
+        discard_outputs(writers)
+        return False
     
-    # Save the new files
-    success1 = save_json_file(data1, output_path1)
-    success2 = save_json_file(data2, output_path2)
+    for writer in writers.values():
+        writer.close()
+        print(f"Successfully saved: {writer.filename}")
+        logging.info(f"Successfully saved: {writer.filename}")
     
     # Print summary
     print(f"\nSummary:")
-    print(f"Total devices in source file: {len(data.get('devices', []))}")
-    print(f"Devices in {output_path1}: {len(data1['devices'])} (dp01 and dp03)")
-    print(f"Devices in {output_path2}: {len(data2['devices'])} (dp02 and dp04)")
+    print(f"Total devices in source file: {total_devices}")
+    for filename, writer in writers.items():
+        descriptions = [rule.describe() for rule in rules if rule.filename == filename]
+        print(f"Devices in {writer.filename}: {writer.counts['device']} ({' | '.join(descriptions)})")
+    matched = sum(writer.counts['device'] for writer in writers.values())
+    if matched < total_devices:
+        print(f"Devices not matched by any rule: {total_devices - matched}")
     
     logging.info('Finished splitting devices.')
-    return success1 and success2
+    return True
 
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Split Cyber-Controller JSON file based on device naming patterns')
-    parser.add_argument('-s', '--source', required=True, help='Source JSON file')
+    parser.add_argument('-r', '--rules', help='Rule file with one output file per section (see splitrules.example); '
+                                              'replaces the default dp01/dp03 - dp02/dp04 split')
+    parser.add_argument('-s', '--source', required=True, help='Source JSON or NDJSON file, or SQLite database')
+    parser.add_argument('-t', '--tree', choices=['physical', 'organization'], default='organization',
+                        help='Tree to split when the source is an SQLite database (default: organization)')
     parser.add_argument('-d', '--dir', default='output', help='Output directory (default: output)')
     parser.add_argument('-o1', '--output1', default='dp01_dp03_devices.json', 
                         help='Output file name for dp01 and dp03 devices (default: dp01_dp03_devices.json)')
     parser.add_argument('-o2', '--output2', default='dp02_dp04_devices.json', 
                         help='Output file name for dp02 and dp04 devices (default: dp02_dp04_devices.json)')
+    add_profile_argument(parser)
     return parser.parse_args()
 
 def main():
@@ -121,14 +319,24 @@ def main():
     
     # Parse command line arguments
     args = parse_arguments()
+    start_profiling(os.path.splitext(log)[0], args.profile)
     
     print(f"Source file: {args.source}")
     print(f"Output directory: {args.dir}")
-    print(f"Output file 1 (dp01/dp03): {os.path.join(args.dir, args.output1)}")
-    print(f"Output file 2 (dp02/dp04): {os.path.join(args.dir, args.output2)}")
+    
+    if args.rules:
+        rules = load_rules(args.rules)
+        if not rules:
+            return
+        print(f"Rule file: {args.rules} ({len(rules)} rules)")
+    else:
+        rules = default_rules(args.output1, args.output2)
+        print(f"Output file 1 (dp01/dp03): {os.path.join(args.dir, args.output1)}")
+        print(f"Output file 2 (dp02/dp04): {os.path.join(args.dir, args.output2)}")
     
     # Split the devices and create the output files
-    split_devices(args.source, args.dir, args.output1, args.output2)
+    with phase('split'):
+        split_devices(args.source, args.dir, rules, args.tree)
     
     logging.info('Finishing the script.')
     print("\nDone.")
@@ -1,13 +1,20 @@
 import time
-import requests
-import urllib3
 import json
 import os
+import argparse
 from configparser import ConfigParser
 from getpass import getpass
 import logging
+from cyber_controller_inventory import Inventory, extract_sites_and_devices, walk_tree
+from cyber_controller_client import (CyberControllerClient, DEFAULT_CONCURRENCY, DEFAULT_SESSION_CACHE_SECONDS,
+                                     device_access_from_response)
+from cyber_controller_journal import Journal
+from cyber_controller_throttle import AdaptiveLimiter, iter_adaptive
+from cyber_controller_stream import NdjsonWriter
+from cyber_controller_db import InventoryStore, DEFAULT_DB_FILE
+from cyber_controller_metrics import write_run_metrics
+from cyber_controller_profile import add_profile_argument, start_profiling, phase as profile_phase
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
 log = current_working_directory + 'download_cybercontroller_objects.log'
 logging.basicConfig(filename=log, filemode='w', format='%(asctime)s - %(message)s',
@@ -51,119 +58,54 @@ def load_config():
         return get_console_input()
 
 
-def login_cyber_controller(ip, user, password):
-    headers = {
-        'authority': ip,
-        'accept': 'application/json; */*',
-        "accept-encoding": "gzip, deflate, br",
-        'accept-language': 'en-US,en;q=0.9,he;q=0.8',
-        'content-type': 'application/json',
-        'sec-ch-ua': '"Google Chrome";v="113", "Chromium";v="113", "Not-A.Brand";v="24"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
-                      ' Chrome/113.0.0.0 Safari/537.36'
-    }
-
-    with requests.sessions.Session() as session:
-        session.auth = (user, password)
-        session.verify = False
-        session.headers = headers
-
-    login_data = '{"username":"' + user + '","password":"' + password + '"}'
-    login_url = 'https://' + ip + '/mgmt/system/user/login'
-    login_response = session.post(login_url, headers=headers, verify=False, data=login_data)
-    if login_response.status_code != 200:
-        print("Cyber-Controller " + ip + " login status code:", login_response.status_code)
-        logging.error("Cyber-Controller " + ip + " login status code: " + str(login_response.status_code))
-        logging.info('Finishing the script.')
-        exit(1)
-    else:
-        return session
-
-
-def get_parent_site_id(parent_site_name, session, dst_cc_ip):
-    parent_site_name_url = 'https://' + dst_cc_ip + '/mgmt/system/config/tree/site/byname/' + parent_site_name
-    parent_site_name_response = session.get(parent_site_name_url, verify=False)
-    data = json.loads(parent_site_name_response.text)
-    if "There is no site with name" in parent_site_name_response.text:
-        return False
-    else:
-        parent_site_id = data['ormID']
-        return parent_site_id
-
-
-def get_parent_site_name(device_parent_id, session, ip):
-    parent_site_id_url = 'https://' + ip + '/mgmt/system/config/tree/site/byid/' + device_parent_id
-    parent_site_id_response = session.get(parent_site_id_url, verify=False)
-    data = json.loads(parent_site_id_response.text)
-    if "There is no site with name" in parent_site_id_response.text:
-        return False
-    else:
-        parent_site_name = data['name']
-        return parent_site_name
-
-
-def extract_sites_and_devices(data, src_session, src_cc_ip, parent_id=None):
-    sites = []
-    devices = []
-
-    for item in data["children"]:
-        if item["meIdentifier"]["managedElementClass"] == "com.radware.insite.model.device.Device":
-            device_parent_id = parent_id if parent_id else data["meIdentifier"]["managedElementID"]
-            device = {
-                "name": item["name"],
-                "type": item["type"],
-                "managementIp": item["managementIp"],
-                "id": item["meIdentifier"]["managedElementID"],
-                "parentOrmID": device_parent_id
-            }
-            devices.append(device)
-        elif item["meIdentifier"]["managedElementClass"] == "com.radware.insite.model.device.Site":
-            site_parent_id = parent_id if parent_id else data["meIdentifier"]["managedElementID"]
-            parent_site_name = get_parent_site_name(site_parent_id, src_session, src_cc_ip)
-
-            site = {
-                "name": item["name"],
-                "id": item["meIdentifier"]["managedElementID"],
-                "parent_site_name": parent_site_name,
-                "parentOrmID": site_parent_id
-            }
-
-            sites.append(site)
-            extracted_sites, extracted_devices = extract_sites_and_devices(item, src_session, src_cc_ip,
-                                                                           item["meIdentifier"]["managedElementID"])
-            sites.extend(extracted_sites)
-            devices.extend(extracted_devices)
-
-    return sites, devices
-
-
-def extract_device_access_data(device_ip, existing_file_data, session, src_cc_ip):
-    url = 'https://' + src_cc_ip + '/mgmt/system/config/tree/device/byip/' + device_ip
-    response = session.get(url, verify=False)
-    data = json.loads(response.text)
-    device_access_data = data["deviceSetup"]['deviceAccess']
-    del device_access_data['ormID']
-
-    for device in existing_file_data['devices']:
-        if device['managementIp'] == device_ip:
-            device['deviceAccess'] = device_access_data
-            break
-
-    return existing_file_data
-
-
-def get_site_name_by_id(site_id, json_data):
-    site_name = None
-    for site in json_data['sites']:
-        if site['id'] == site_id:
-            site_name = site['name']
-            break
-    return site_name
+def stream_device_access_data(devices, client):
+    """Yield (device, deviceAccess) for each device, in order.
+
+    The requests go through the adaptive engine of cyber_controller_throttle:
+    up to client.concurrency in flight, 429/5xx and timeouts retried with a
+    backoff, and only a small window of devices pending, so memory does not
+    grow with the number of devices. deviceAccess is None for a device that
+    still failed after the retries; the failure is logged.
+    """
+    def get_device(device):
+        return client.get('/mgmt/system/config/tree/device/byip/' + device['managementIp'])
+
+    for device, response, error in iter_adaptive(devices, get_device, AdaptiveLimiter(client.concurrency)):
+        try:
+            if response is None or response.status_code != 200:
+                raise ValueError(error or f"status code {response.status_code}")
+            device_access_data = device_access_from_response(response)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Failed to get deviceAccess for device {device['managementIp']}: {str(e)}")
+            device_access_data = None
+        yield device, device_access_data
+
+
+def extract_device_access_data(existing_file_data, client, journal=None):
+    """Fetch deviceAccess for every device that does not have it yet.
+
+    Devices that already have deviceAccess (resumed run) are not fetched
+    again, and every fetched record is appended to the journal when given.
+    A device that fails is logged and left without deviceAccess; the
+    remaining devices still run. Returns the number of devices left without
+    deviceAccess.
+    """
+    devices = [device for device in existing_file_data['devices'] if 'deviceAccess' not in device]
+    failed = 0
+
+    for device, device_access_data in stream_device_access_data(devices, client):
+        if device_access_data is None:
+            failed += 1
+            continue
+        device['deviceAccess'] = device_access_data
+        if journal:
+            journal.append({"record": "deviceAccess", "managementIp": device['managementIp'],
+                            "deviceAccess": device_access_data})
+
+    if failed:
+        print(f"Failed to get deviceAccess for {failed} device(s), see {log}")
+
+    return failed
 
 
 def write_json_to_file(data, filename):
@@ -172,49 +114,238 @@ def write_json_to_file(data, filename):
             json.dump(data, f, indent=4)
         logging.info(f'Successfully wrote data to {filename}')
         print(f'Data has been written to {filename}')
+        return True
     except Exception as e:
         logging.error(f'Error writing to file: {str(e)}')
         print(f'Error writing to file: {str(e)}')
+        return False
 
 
-def main(src_cc_ip, src_cc_user, src_cc_password, url_suffix):
-    src_session = login_cyber_controller(src_cc_ip, src_cc_user, src_cc_password)
+def load_checkpoint(journal):
+    """Rebuild a partial download from its journal.
 
-    url = 'https://' + src_cc_ip + url_suffix
-    response = src_session.get(url, verify=False)
-    data = json.loads(response.text)
+    Returns (final_json, complete). final_json is None when the journal does
+    not hold a complete site/device walk of the tree; complete is True when
+    the JSON file of this tree was already written.
+    """
+    sites = []
+    devices = []
+    device_access = {}
+    final_json = None
+    complete = False
+
+    for record in journal.records():
+        kind = record.pop("record", None)
+        if kind == "site":
+            sites.append(record)
+        elif kind == "device":
+            devices.append(record)
+        elif kind == "tree":
+            final_json = {"sites": sites, "devices": devices}
+        elif kind == "deviceAccess":
+            device_access[record["managementIp"]] = record["deviceAccess"]
+        elif kind == "complete":
+            complete = True
+
+    if final_json:
+        inventory = Inventory(final_json)
+        for device_ip, device_access_data in device_access.items():
+            device = inventory.device_by_ip(device_ip)
+            if device:
+                device['deviceAccess'] = device_access_data
+
+    return final_json, complete
+
+
+def main(client, url_suffix, resume=False, store=None):
+    """Download one tree into its JSON file. Returns (journal, complete).
+
+    complete is False when the file could not be written or some devices
+    are still without deviceAccess; the journal then has no "complete"
+    record, so --resume fetches the missing devices again.
+    """
+    # Generate filenames based on the URL suffix
+    tree_name = url_suffix.split("/")[-1].lower()
+    filename = f'cyber_controller_{tree_name}.json'
+    journal = Journal(f'cyber_controller_{tree_name}.journal', resume)
+
+    final_json, complete = load_checkpoint(journal) if resume else (None, False)
+    if complete:
+        print(f'{filename} was already downloaded, skipping')
+        journal.close()
+        return journal, True
+
+    if final_json is None:
+        if resume:
+            # Nothing usable to resume from, start this tree over
+            journal.close()
+            journal = Journal(journal.filename)
+
+        with client.metrics.phase('tree_fetch'):
+            response = client.get(url_suffix)
+            with profile_phase('tree_parse'):
+                data = json.loads(response.text)
+
+        # Extract sites and devices
+        with client.metrics.phase('site_walk'):
+            extracted_sites, extracted_devices = extract_sites_and_devices(data)
+
+        # Construct the final JSON structure
+        final_json = {
+            "sites": extracted_sites,
+            "devices": extracted_devices
+        }
 
-    # Extract sites and devices
-    extracted_sites, extracted_devices = extract_sites_and_devices(data, src_session, src_cc_ip)
+        for site in extracted_sites:
+            journal.append(dict(site, record="site"))
+        for device in extracted_devices:
+            journal.append(dict(device, record="device"))
+        journal.append({"record": "tree"})
+    else:
+        fetched = sum(1 for device in final_json['devices'] if 'deviceAccess' in device)
+        print(f'Resuming {tree_name}: {fetched} of {len(final_json["devices"])} devices already fetched')
+
+    with client.metrics.phase('device_access_fetch'):
+        failed = extract_device_access_data(final_json, client, journal)
+
+    with client.metrics.phase('file_write'):
+        if store:
+            store.save_tree(tree_name, final_json)
+            logging.info(f'Successfully wrote {tree_name} tree to {store.filename}')
+
+        written = write_json_to_file(final_json, filename)
+    complete = written and not failed
+    if complete:
+        journal.append({"record": "complete"})
+    elif failed:
+        print(f'{filename} is incomplete: {failed} device(s) without deviceAccess, run again with --resume')
+        logging.error(f'{filename} is incomplete: {failed} device(s) without deviceAccess')
+    journal.close()
+    return journal, complete
+
+
+def stream_main(client, url_suffix, store=None):
+    """Download one tree into an NDJSON file, writing every record as soon as it is complete.
+
+    Sites are written while the tree is walked and each device once its
+    deviceAccess arrives; no list of sites, devices or deviceAccess records
+    is kept in memory. Returns the number of devices written without
+    deviceAccess.
+    """
+    tree_name = url_suffix.split("/")[-1].lower()
+    filename = f'cyber_controller_{tree_name}.ndjson'
+
+    with client.metrics.phase('tree_fetch'):
+        response = client.get(url_suffix)
+        with profile_phase('tree_parse'):
+            data = json.loads(response.text)
+        del response
+
+    writer = NdjsonWriter(filename)
+    failed = 0
+    if store:
+        store.clear_tree(tree_name)
+
+    def tree_devices():
+        for kind, record in walk_tree(data):
+            if kind == "site":
+                writer.write("site", record)
+                if store:
+                    store.add(tree_name, "site", record)
+            else:
+                yield record
 
-    # Construct the final JSON structure
-    final_json = {
-        "sites": extracted_sites,
-        "devices": extracted_devices
-    }
+    try:
+        # The site walk and the file writes are interleaved with the deviceAccess requests
+        with client.metrics.phase('device_access_fetch'):
+            for device, device_access_data in stream_device_access_data(tree_devices(), client):
+                if device_access_data is None:
+                    failed += 1
+                else:
+                    device['deviceAccess'] = device_access_data
+                writer.write("device", device)
+                if store:
+                    store.add(tree_name, "device", device)
+        if store:
+            store.commit()
+    finally:
+        writer.close()
+
+    logging.info(f'Successfully wrote data to {filename}')
+    print(f'Data has been written to {filename}')
+    if failed:
+        print(f"{filename} is incomplete: failed to get deviceAccess for {failed} device(s), see {log}")
+        logging.error(f'{filename} is incomplete: {failed} device(s) without deviceAccess')
+    return failed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Download Cyber-Controller objects to JSON files')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Number of parallel deviceAccess requests (default: {DEFAULT_CONCURRENCY})')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-r', '--resume', action='store_true',
+                      help='Resume an interrupted download from its journal files')
+    mode.add_argument('-n', '--ndjson', action='store_true',
+                      help='Stream the records to cyber_controller_<tree>.ndjson files as they are fetched')
+    parser.add_argument('-s', '--sqlite', nargs='?', const=DEFAULT_DB_FILE, default=None, metavar='DB',
+                        help=f'Also store both trees in an SQLite database (default file: {DEFAULT_DB_FILE})')
+    parser.add_argument('--session-cache', type=int, default=DEFAULT_SESSION_CACHE_SECONDS, metavar='SECONDS',
+                        help=f'Reuse the login session of a previous run up to this many seconds after its login,'
+                             f' 0 to always log in (default: {DEFAULT_SESSION_CACHE_SECONDS})')
+    add_profile_argument(parser)
+    return parser.parse_args()
 
-    for device in final_json['devices']:
-        device_ip = device['managementIp']
-        final_json = extract_device_access_data(device_ip, final_json, src_session, src_cc_ip)
-    
-    # Generate filename based on the URL suffix
-    filename = f'cyber_controller_{url_suffix.split("/")[-1].lower()}.json'
-    write_json_to_file(final_json, filename)
-    
 
 if __name__ == "__main__":
     logging.info('Starting the script.')
+
+    # Parse command line arguments
+    args = parse_arguments()
+    start_profiling(os.path.splitext(log)[0], args.profile)
     
     # Load credentials from config file or fall back to console input
     credentials = load_config()
+
+    # Log in once and share the session for both trees
+    client = CyberControllerClient(credentials['ip'], credentials['username'], credentials['password'],
+                                   args.concurrency, session_cache_seconds=args.session_cache)
+
+    store = InventoryStore(args.sqlite) if args.sqlite else None
     
-    # Execute main function for both endpoints
-    main(credentials['ip'], credentials['username'], credentials['password'],
-         '/mgmt/system/config/tree/Physical')
-    
-    main(credentials['ip'], credentials['username'], credentials['password'],
-         '/mgmt/system/config/tree/Organization')
+    if args.ndjson:
+        # Stream both trees to NDJSON files
+        failed = stream_main(client, '/mgmt/system/config/tree/Physical', store)
+        failed += stream_main(client, '/mgmt/system/config/tree/Organization', store)
+        complete = not failed
+        client.close()
+    else:
+        # Execute main function for both endpoints
+        physical_journal, physical_complete = main(client, '/mgmt/system/config/tree/Physical', args.resume, store)
+
+        organization_journal, organization_complete = main(client, '/mgmt/system/config/tree/Organization',
+                                                           args.resume, store)
+        complete = physical_complete and organization_complete
+
+        client.close()
+
+        # A tree written with all its deviceAccess does not need its journal to resume anymore
+        if physical_complete:
+            physical_journal.remove()
+        if organization_complete:
+            organization_journal.remove()
+
+    if store:
+        store.close()
+        print(f'Data has been written to {store.filename}')
+
+    write_run_metrics(client.metrics, log)
      
+    if not complete:
+        print("The download is incomplete, see the messages above.")
+        logging.info('Finishing the script, the download is incomplete.')
+        exit(1)
+
     logging.info('Finishing the script.')
     print("Done.")
 #    print("This prompt will be closed in 5 seconds.")
@@ -0,0 +1,234 @@
+import json
+import os
+import argparse
+from configparser import ConfigParser
+from getpass import getpass
+import logging
+from cyber_controller_inventory import walk_tree
+from cyber_controller_client import (CyberControllerClient, DEFAULT_CONCURRENCY, DEFAULT_SESSION_CACHE_SECONDS,
+                                     device_access_from_response)
+from cyber_controller_throttle import AdaptiveLimiter, RateLimiter, iter_adaptive
+from cyber_controller_metrics import write_run_metrics
+from cyber_controller_profile import add_profile_argument, start_profiling
+from update_json_credentials import RotationRules, RotationReport, load_rules, rotate_access
+
+current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
+log = current_working_directory + 'rotate_cybercontroller_credentials.log'
+logging.basicConfig(filename=log, filemode='w', format='%(asctime)s - %(message)s',
+                    level=logging.INFO)
+
+REQUEST_TIMEOUT = 60
+REPORT_FILE = 'rotate_cybercontroller_credentials_report.csv'
+PLANNED_REPORT_FILE = 'rotate_cybercontroller_credentials_planned.csv'
+
+def get_console_input():
+    print("--- Cyber-Controller Details ---")
+    ip = input("Address: ")
+    username = input("Username: ")
+    password = getpass("Password: ")
+    return {
+        'ip': ip,
+        'username': username,
+        'password': password
+    }
+
+def load_config():
+    config = ConfigParser()
+    config_file = 'update.ini'
+
+    if not os.path.exists(config_file):
+        logging.info("Configuration file not found. Falling back to console input.")
+        print("Configuration file not found. Please enter credentials manually.")
+        return get_console_input()
+
+    try:
+        config.read(config_file)
+        credentials = {
+            'ip': config.get('credentials', 'ip'),
+            'username': config.get('credentials', 'username'),
+            'password': config.get('credentials', 'password')
+        }
+        logging.info("Successfully loaded credentials from config file")
+        print("Successfully loaded credentials from config file")
+        return credentials
+    except Exception as e:
+        logging.error(f"Error reading configuration: {str(e)}. Falling back to console input.")
+        print(f"Error reading configuration: {str(e)}")
+        print("Falling back to manual input.")
+        return get_console_input()
+
+def update_concurrency(concurrency):
+    """Number of parallel updates that run alongside concurrency parallel reads."""
+    return max(1, concurrency // 2)
+
+def rotate_tree(client, tree_type, rules, report, concurrency=DEFAULT_CONCURRENCY, rate=None,
+                timeout=REQUEST_TIMEOUT, dry_run=False):
+    """Rotate the credentials of the devices of one tree, straight on the controller.
+
+    The devices come from the tree response; their deviceAccess is read,
+    rewritten with the rules in memory and PUT back, without any file in
+    between. Usernames are only in deviceAccess, so every device is read,
+    but only the devices a rule matches are updated. The reads and the
+    updates run as two overlapping stages, up to concurrency reads and
+    half as many updates at a time. Each stage adapts its own limit, as a
+    PUT is normally slower than a GET and would otherwise look like
+    congestion; rate caps the requests per second of both stages together.
+    A change is added to report once its PUT succeeded; with dry_run, the
+    changes that would be sent are added instead.
+    Returns (updated, failed) device counts.
+    """
+    with client.metrics.phase('tree_fetch'):
+        response = client.get(f'/mgmt/system/config/tree/{tree_type}', timeout=timeout)
+        # The devices are only iterated, in tree order: no indexed inventory is built
+        devices = [record for kind, record in walk_tree(json.loads(response.text)) if kind == "device"]
+    print(f"Reading the deviceAccess of {len(devices)} devices...")
+
+    read_limiter = AdaptiveLimiter(concurrency)
+    update_limiter = AdaptiveLimiter(update_concurrency(concurrency))
+    rate_limiter = RateLimiter(rate) if rate else None
+    failed = 0
+
+    def get_device(device):
+        return client.get('/mgmt/system/config/tree/device/byip/' + device['managementIp'], timeout=timeout)
+
+    def put_device(rotated):
+        device, _, access, _ = rotated
+        payload = {
+            "name": device['name'],
+            "parentOrmID": device['parentOrmID'],
+            "type": device['type'],
+            "ormID": device['id'],
+            "deviceSetup": {
+                "deviceAccess": access
+            }
+        }
+        return client.put('/mgmt/system/config/tree/device', json=payload, timeout=timeout)
+
+    def rotated_devices():
+        """Second stage: rewrite each deviceAccess as it arrives and keep the ones that changed.
+
+        Yields (device, current deviceAccess, rotated deviceAccess, changes).
+        """
+        nonlocal failed
+        for device, response, error in iter_adaptive(devices, get_device, read_limiter, rate_limiter):
+            try:
+                if response is None or response.status_code != 200:
+                    raise ValueError(error or f"status code {response.status_code}")
+                access = device_access_from_response(response)
+            except (ValueError, KeyError, TypeError) as e:
+                failed += 1
+                print(f"Failed to get deviceAccess of device: {device['name']}")
+                logging.error(f"Failed to get deviceAccess of device - {device['name']} {str(e)}")
+                continue
+
+            rotated_access, changes = rotate_access(access, rules)
+            if changes:
+                yield device, access, rotated_access, changes
+            else:
+                report.add(dict(device, deviceAccess=access), changes)
+
+    if dry_run:
+        planned = 0
+        with client.metrics.phase('device_access_fetch'):
+            for device, _, access, changes in rotated_devices():
+                report.add(dict(device, deviceAccess=access), changes)
+                planned += 1
+        print(f"Devices to update: {planned} (dry run, nothing was sent)")
+        return 0, failed
+
+    updated = 0
+    # The reads and the updates overlap, so they are timed as one phase
+    with client.metrics.phase('device_rotate'):
+        results = iter_adaptive(rotated_devices(), put_device, update_limiter, rate_limiter)
+        for (device, access, rotated_access, changes), response, error in results:
+            device_name = device['name']
+            if response is None:
+                failed += 1
+                print(f"Failed to update device: {device_name}")
+                logging.error(f"Failed to update device - {device_name} {str(error)}")
+            elif response.status_code != 200:
+                failed += 1
+                print(f"Failed to update device: {device_name}")
+                try:
+                    message = response.json()['message']
+                except (ValueError, KeyError):
+                    message = f"status code {response.status_code}"
+                logging.error(f"Failed to update device - {device_name} {message}")
+            else:
+                updated += 1
+                logging.info(f"Updated device: {device_name}")
+                report.add(dict(device, deviceAccess=rotated_access), changes)
+                continue
+            # The device keeps its current credentials
+            report.add(dict(device, deviceAccess=access), [])
+
+    print(f"Devices updated: {updated}, failed: {failed}")
+    return updated, failed
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Rotate device credentials on a Cyber-Controller with the rules of clicredentials.ini'
+                    ' and snmpsecrets.ini, without downloading the trees to files')
+    parser.add_argument('-t', '--tree', choices=['Organization', 'Physical'], action='append',
+                        help='Tree whose devices are rotated, can be repeated (default: Organization)')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Maximum number of parallel reads, up to half as many updates run alongside'
+                             f' (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Maximum number of requests per second (default: no limit)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Read and rewrite the credentials, but do not update any device')
+    parser.add_argument('--timeout', type=int, default=REQUEST_TIMEOUT,
+                        help=f'Seconds to wait for each request (default: {REQUEST_TIMEOUT})')
+    parser.add_argument('--session-cache', type=int, default=DEFAULT_SESSION_CACHE_SECONDS, metavar='SECONDS',
+                        help=f'Reuse the login session of a previous run up to this many seconds after its login,'
+                             f' 0 to always log in (default: {DEFAULT_SESSION_CACHE_SECONDS})')
+    add_profile_argument(parser)
+    return parser.parse_args()
+
+def main():
+    logging.info('Starting the script.')
+    args = parse_arguments()
+    start_profiling(os.path.splitext(log)[0], args.profile)
+
+    rules = RotationRules()
+    cli_rules = load_rules('clicredentials.ini', 'cli', rules)
+    snmp_rules = load_rules('snmpsecrets.ini', 'snmp', rules)
+    if cli_rules is None and snmp_rules is None:
+        print("Error: Neither clicredentials.ini nor snmpsecrets.ini found!")
+        return
+    if not len(rules):
+        print("Error: No rules to apply")
+        return
+
+    credentials = load_config()
+    # One pooled connection for each read and update that can be in flight
+    client = CyberControllerClient(credentials['ip'], credentials['username'], credentials['password'],
+                                   args.concurrency + update_concurrency(args.concurrency), supportasync=True,
+                                   session_cache_seconds=args.session_cache)
+
+    report = RotationReport(planned=args.dry_run)
+    failed = 0
+    for tree_type in args.tree or ['Organization']:
+        print(f"\nRotating the credentials of the {tree_type} tree...")
+        failed += rotate_tree(client, tree_type, rules, report, args.concurrency, args.rate, args.timeout,
+                              args.dry_run)[1]
+
+    if report.changed_devices:
+        report.print_changes()
+        report_file = PLANNED_REPORT_FILE if args.dry_run else REPORT_FILE
+        report.write_csv(report_file)
+        print(f"List of the {'usernames to change' if args.dry_run else 'changed usernames'} saved to {report_file}")
+    elif failed:
+        print(f"\nNo device was updated - {failed} device(s) failed, see {log}")
+    else:
+        print("\nNo device matched the rules - nothing was updated")
+        report.print_usernames()
+
+    client.close()
+    write_run_metrics(client.metrics, log)
+    logging.info('Finishing the script.')
+    print("\nDone.")
+
+if __name__ == "__main__":
+    main()
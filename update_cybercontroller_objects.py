@@ -1,19 +1,24 @@
-import time
-import requests
-import urllib3
 import json
 import os
 import argparse
 from configparser import ConfigParser
 from getpass import getpass
 import logging
+from cyber_controller_inventory import Inventory
+from cyber_controller_client import (CyberControllerClient, DEFAULT_CONCURRENCY, DEFAULT_SESSION_CACHE_SECONDS,
+                                     device_access_from_response)
+from cyber_controller_throttle import run_adaptive
+from cyber_controller_db import load_tree, DEFAULT_DB_FILE
+from cyber_controller_metrics import write_run_metrics
+from cyber_controller_profile import add_profile_argument, start_profiling
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
 log = current_working_directory + 'update_cybercontroller_objects.log'
 logging.basicConfig(filename=log, filemode='w', format='%(asctime)s - %(message)s',
                     level=logging.INFO)
 
+REQUEST_TIMEOUT = 60
+
 def get_console_input():
     print("--- Destination Cyber-Controller Details ---")
     ip = input("Address: ")
@@ -50,84 +55,6 @@ def load_config():
         print("Falling back to manual input.")
         return get_console_input()
 
-def login_cyber_controller(ip, user, password):
-    headers = {
-        'authority': ip,
-        'accept': 'application/json; */*',
-        "accept-encoding": "gzip, deflate, br",
-        'accept-language': 'en-US,en;q=0.9,he;q=0.8',
-        'content-type': 'application/json',
-        'sec-ch-ua': '"Google Chrome";v="113", "Chromium";v="113", "Not-A.Brand";v="24"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'supportasync': 'true',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
-                      ' Chrome/113.0.0.0 Safari/537.36'
-    }
-
-    with requests.sessions.Session() as session:
-        session.auth = (user, password)
-        session.verify = False
-        session.headers = headers
-
-    login_data = '{"username":"' + user + '","password":"' + password + '"}'
-    login_url = 'https://' + ip + '/mgmt/system/user/login'
-    login_response = session.post(login_url, headers=headers, verify=False, data=login_data)
-    if login_response.status_code != 200:
-        print("Cyber-Controller " + ip + " login status code:", login_response.status_code)
-        logging.error("Cyber-Controller " + ip + " login status code: " + str(login_response.status_code))
-        logging.info('Finishing the script.')
-        exit(1)
-    else:
-        return session
-
-def get_parent_site_id(parent_site_name, session, dst_cc_ip):
-    parent_site_name_url = 'https://' + dst_cc_ip + '/mgmt/system/config/tree/site/byname/' + parent_site_name
-    try:
-        parent_site_name_response = session.get(parent_site_name_url, verify=False)
-        data = json.loads(parent_site_name_response.text)
-        
-        # Debug logging to see the actual response
-        logging.debug(f"API Response for site {parent_site_name}: {parent_site_name_response.text}")
-        
-        # Check if the response indicates no site found
-        if "There is no site with name" in parent_site_name_response.text:
-            logging.info(f"No site found with name: {parent_site_name}")
-            return False
-            
-        # Check if we have a valid response with meIdentifier
-        if 'meIdentifier' in data and 'managedElementID' in data['meIdentifier']:
-            return data['meIdentifier']['managedElementID']
-        
-        # If we have ormID directly
-        if 'ormID' in data:
-            return data['ormID']
-            
-        # If we couldn't find any valid ID
-        logging.error(f"Unexpected API response format for site {parent_site_name}: {data}")
-        return False
-        
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Request failed for site {parent_site_name}: {str(e)}")
-        return False
-    except json.JSONDecodeError as e:
-        logging.error(f"Failed to parse JSON response for site {parent_site_name}: {str(e)}")
-        return False
-    except Exception as e:
-        logging.error(f"Unexpected error getting parent site ID for {parent_site_name}: {str(e)}")
-        return False
-
-def get_site_name_by_id(site_id, json_data):
-    site_name = None
-    for site in json_data['sites']:
-        if site['id'] == site_id:
-            site_name = site['name']
-            break
-    return site_name
-
 def load_json_file(filename):
     try:
         with open(filename, 'r') as f:
@@ -141,22 +68,72 @@ def load_json_file(filename):
         print(f"Error: Invalid JSON format in file {filename}")
         return None
 
-def upload_configuration(dst_cc_ip, dst_cc_user, dst_cc_password, json_data, tree_type):
-    dst_session = login_cyber_controller(dst_cc_ip, dst_cc_user, dst_cc_password)
-    
-    # Get root site information
-    url = f'https://{dst_cc_ip}/mgmt/system/config/tree/{tree_type}'
-    response = dst_session.get(url, verify=False)
-    data = json.loads(response.text)
-    dst_cc_root_site_id = data["meIdentifier"]["managedElementID"]
+def device_access_differs(desired, current):
+    """Compare the deviceAccess fields of the JSON file with the ones on the destination."""
+    return any(current.get(key) != value for key, value in desired.items() if key != 'ormID')
 
-    # Update devices
-    for device in json_data["devices"]:
-        device_name = device['name']
+def get_changed_devices(client, devices, destination, rate=None, timeout=REQUEST_TIMEOUT):
+    """Split the devices into changed, unchanged, missing on the destination and failed.
+
+    The current deviceAccess of all the devices is read in parallel (same
+    adaptive engine as the updates); devices that are not in the destination
+    tree are reported as missing without a request. failed holds the
+    devices whose deviceAccess could not be read (timeout, error status,
+    invalid response).
+    """
+    changed = []
+    unchanged = []
+    missing = []
+    failed = []
+
+    present = []
+    for device in devices:
+        if destination.device_by_ip(device['managementIp']):
+            present.append(device)
+        else:
+            missing.append(device)
+
+    def get_device(device):
+        return client.get('/mgmt/system/config/tree/device/byip/' + device['managementIp'], timeout=timeout)
+
+    for device, response, error in run_adaptive(present, get_device, client.concurrency, rate):
+        try:
+            if response is None or response.status_code != 200:
+                raise ValueError(error or f"status code {response.status_code}")
+            current = device_access_from_response(response)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Failed to get deviceAccess of device - {device['name']} {str(e)}")
+            failed.append(device)
+            continue
+
+        if device_access_differs(device['deviceAccess'], current):
+            changed.append(device)
+        else:
+            unchanged.append(device)
+
+    return changed, unchanged, missing, failed
+
+def upload_configuration(client, json_data, tree_type, rate=None, timeout=REQUEST_TIMEOUT, delta=False):
+    """PUT the devices of json_data to the destination.
+
+    The PUTs run in parallel; the number in flight adapts to the
+    controller's latency and 429/5xx/timeouts, up to client.concurrency,
+    and rate optionally caps the requests per second. With delta only the
+    devices whose deviceAccess differs from the destination are sent.
+    Returns the list of (device, response, error) results.
+    """
+    # Get the destination tree once, all parent sites are resolved from it
+    with client.metrics.phase('tree_fetch'):
+        response = client.get(f'/mgmt/system/config/tree/{tree_type}')
+        data = json.loads(response.text)
+        destination = Inventory.from_tree(data)
+    inventory = Inventory(json_data)
+
+    def update_device(device):
         orm_ID = device['id']
         src_parent_device_id = device['parentOrmID']
-        parent_site_name = get_site_name_by_id(src_parent_device_id, json_data)
-        parent_orm_id = dst_cc_root_site_id if not parent_site_name else get_parent_site_id(parent_site_name, dst_session, dst_cc_ip)
+        parent_site_name = inventory.site_name(src_parent_device_id)
+        parent_orm_id = destination.root_id if not parent_site_name else destination.site_id_by_name(parent_site_name)
 
         payload = {
             "name": device['name'],
@@ -167,53 +144,126 @@ def upload_configuration(dst_cc_ip, dst_cc_user, dst_cc_password, json_data, tre
                 "deviceAccess": device['deviceAccess']
             }
         }
-        url = f'https://{dst_cc_ip}/mgmt/system/config/tree/device'
-        response = dst_session.put(url, verify=False, json=payload)
-        if response.status_code != 200:
+        return client.put('/mgmt/system/config/tree/device', json=payload, timeout=timeout)
+
+    # A device the download could not get the deviceAccess of cannot be updated
+    devices = []
+    skipped = 0
+    for device in inventory.devices:
+        if 'deviceAccess' in device:
+            devices.append(device)
+        else:
+            skipped += 1
+            print(f"Failed to update device: {device['name']}")
+            logging.error(f"Failed to update device - {device['name']} no deviceAccess in the file")
+
+    if delta:
+        with client.metrics.phase('device_access_fetch'):
+            devices, unchanged, missing, failed = get_changed_devices(client, devices, destination, rate, timeout)
+        for device in missing:
+            print(f"Device not found on the destination: {device['name']}")
+            logging.error(f"Device not found on the destination - {device['name']}")
+        for device in failed:
+            print(f"Failed to read the deviceAccess of device on the destination: {device['name']}")
+        # Not updated, since it is unknown whether they differ
+        skipped += len(failed)
+        print(f"Devices changed: {len(devices)}, unchanged: {len(unchanged)}, missing: {len(missing)}, "
+              f"failed to read: {len(failed)}")
+
+    # Update devices
+    with client.metrics.phase('device_update'):
+        results = run_adaptive(devices, update_device, client.concurrency, rate)
+
+    updated = 0
+    for device, response, error in results:
+        device_name = device['name']
+        if response is None:
+            print(f"Failed to update device: {device_name}")
+            logging.error(f"Failed to update device - {device_name} {str(error)}")
+        elif response.status_code != 200:
             print(f"Failed to update device: {device_name}")
-            error = response.json()
-            logging.error(f"Failed to update device - {device_name} {error['message']}")
+            try:
+                message = response.json()['message']
+            except (ValueError, KeyError):
+                message = f"status code {response.status_code}"
+            logging.error(f"Failed to update device - {device_name} {message}")
         else:
+            updated += 1
             print(f"Updated device: {device_name}")
             logging.info(f"Updated device: {device_name}")
 
+    print(f"Devices updated: {updated}, failed: {len(results) - updated + skipped}")
+    return results
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Update Cyber-Controller objects from JSON files')
     parser.add_argument('-p', '--physical', required=False, help='Path to physical tree JSON file')
     parser.add_argument('-o', '--organizational', required=False, help='Path to organizational tree JSON file')
-    return parser.parse_args()
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Maximum number of parallel updates (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Maximum number of requests per second (default: no limit)')
+    parser.add_argument('-d', '--delta', action='store_true',
+                        help='Only update devices whose deviceAccess differs from the destination')
+    parser.add_argument('--timeout', type=int, default=REQUEST_TIMEOUT,
+                        help=f'Seconds to wait for each update request (default: {REQUEST_TIMEOUT})')
+    parser.add_argument('-s', '--sqlite', nargs='?', const=DEFAULT_DB_FILE, default=None, metavar='DB',
+                        help=f'Read both trees from an SQLite database written by the download'
+                             f' (default file: {DEFAULT_DB_FILE})')
+    parser.add_argument('--session-cache', type=int, default=DEFAULT_SESSION_CACHE_SECONDS, metavar='SECONDS',
+                        help=f'Reuse the login session of a previous run up to this many seconds after its login,'
+                             f' 0 to always log in (default: {DEFAULT_SESSION_CACHE_SECONDS})')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.sqlite and (args.physical or args.organizational):
+        parser.error('-s/--sqlite cannot be combined with -p or -o')
+    return args
 
 def main():
     logging.info('Starting the script.')
     
     # Parse command line arguments
     args = parse_arguments()
+    start_profiling(os.path.splitext(log)[0], args.profile)
     
     # Load credentials from config file or fall back to console input
     credentials = load_config()
+
+    # Log in once and share the session for both trees
+    client = CyberControllerClient(credentials['ip'], credentials['username'], credentials['password'],
+                                   args.concurrency, supportasync=True,
+                                   session_cache_seconds=args.session_cache)
     
     # Process Physical tree configuration if provided
-    if args.physical:
-        physical_json = load_json_file(args.physical)
+    if args.physical or args.sqlite:
+        if args.sqlite:
+            physical_json = load_tree(args.sqlite, 'physical')
+        else:
+            physical_json = load_json_file(args.physical)
         if physical_json:
-            print(f"\nUploading Physical tree configuration from {args.physical}...")
-            upload_configuration(credentials['ip'], credentials['username'], credentials['password'], 
-                               physical_json, 'Physical')
+            print(f"\nUploading Physical tree configuration from {args.sqlite or args.physical}...")
+            upload_configuration(client, physical_json, 'Physical', args.rate, args.timeout,
+                                 args.delta)
     
     # Process Organization tree configuration if provided
-    if args.organizational:
-        organization_json = load_json_file(args.organizational)
+    if args.organizational or args.sqlite:
+        if args.sqlite:
+            organization_json = load_tree(args.sqlite, 'organization')
+        else:
+            organization_json = load_json_file(args.organizational)
         if organization_json:
-            print(f"\nUploading Organization tree configuration from {args.organizational}...")
-            upload_configuration(credentials['ip'], credentials['username'], credentials['password'], 
-                               organization_json, 'Organization')
+            print(f"\nUploading Organization tree configuration from {args.sqlite or args.organizational}...")
+            upload_configuration(client, organization_json, 'Organization', args.rate, args.timeout,
+                                 args.delta)
     
     # If no files were provided, inform the user
-    if not args.physical and not args.organizational:
+    if not args.physical and not args.organizational and not args.sqlite:
         print("No input files specified. Use -p for physical tree JSON and -o for organizational tree JSON.")
         parser = argparse.ArgumentParser()
         parser.print_help()
     
+    client.close()
+    write_run_metrics(client.metrics, log)
     logging.info('Finishing the script.')
     print("\nDone.")
 
@@ -1,195 +1,260 @@
-import json
+import argparse
 import configparser
+import copy
+import csv
+import fnmatch
 import os
-from typing import Dict, Optional, List
+import re
+from collections import Counter
+from typing import Dict, Optional, List, Tuple
+from cyber_controller_stream import iter_export_records, JsonExportWriter
+from cyber_controller_profile import add_profile_argument, start_profiling, phase
 
-def load_json_config(filename: str) -> Dict:
-    """Load and parse the JSON configuration file."""
-    with open(filename, 'r') as f:
-        return json.load(f)
+# deviceAccess fields rotated by each kind of rule: username field -> password fields
+ROTATED_FIELDS = {
+    'cli': [
+        ('cliUsername', ('cliPassword',)),
+        ('httpUsername', ('httpPassword',)),
+        ('httpsUsername', ('httpsPassword',)),
+    ],
+    'snmp': [
+        ('snmpV3Username', ('snmpV3AuthenticationPassword', 'snmpV3PrivacyPassword')),
+    ],
+}
 
-def load_credentials(filename: str) -> Optional[Dict]:
-    """Load credentials from an INI file."""
+# old-user values starting with this prefix are regular expressions
+REGEX_PREFIX = 're:'
+
+class RotationRules:
+    """CLI and SNMP rotation rules compiled into one lookup table.
+    
+    An old-user is matched exactly, as a wildcard (* ? [...]) or, with the
+    "re:" prefix, as a regular expression. Exact users are found in a
+    dictionary; the patterns are only tried, in file order, for usernames
+    without an exact rule, and the answer for each username is cached, so
+    every distinct username is resolved once per run.
+    """
+    
+    def __init__(self):
+        self._exact = {}
+        self._patterns = []
+        self._cache = {}
+    
+    def __len__(self):
+        return len(self._exact) + len(self._patterns)
+    
+    def add(self, kind: str, old_user: str, new_user: str, passwords: Tuple[str, ...]) -> bool:
+        """Add a rule. An exact old-user defined again replaces its earlier rule; returns True then."""
+        rule = (new_user, passwords)
+        replaced = False
+        if old_user.startswith(REGEX_PREFIX):
+            self._patterns.append((kind, re.compile(old_user[len(REGEX_PREFIX):]), rule))
+        elif any(character in old_user for character in '*?['):
+            self._patterns.append((kind, re.compile(fnmatch.translate(old_user)), rule))
+        else:
+            replaced = (kind, old_user) in self._exact
+            self._exact[(kind, old_user)] = rule
+        self._cache.clear()
+        return replaced
+    
+    def match(self, kind: str, username: str) -> Optional[Tuple[str, Tuple[str, ...]]]:
+        """Return (new username, passwords) of the rule for this username, or None."""
+        key = (kind, username)
+        if key not in self._cache:
+            rule = self._exact.get(key)
+            if rule is None:
+                rule = next((rule for rule_kind, pattern, rule in self._patterns
+                             if rule_kind == kind and pattern.fullmatch(username)), None)
+            self._cache[key] = rule
+        return self._cache[key]
+
+def load_rules(filename: str, kind: str, rules: RotationRules) -> Optional[int]:
+    """Add the rules of a clicredentials.ini ("cli") or snmpsecrets.ini ("snmp") file.
+    
+    Returns the number of rules loaded, or None if the file does not exist.
+    
+    Values are read as they are written, without interpolation, so that
+    patterns can use '%': a '%%' in a password is now two characters, where
+    earlier versions read it as a single '%'. Such passwords get a warning.
+    """
     if not os.path.exists(filename):
         return None
-        
-    config = configparser.ConfigParser()
+    
+    config = configparser.ConfigParser(interpolation=None)
     config.read(filename)
-    print(f"\nLoading credentials from {filename}")
     
-    credentials = {}
-    # Process each user section
+    loaded = 0
     for section in config.sections():
-        if 'old-user' not in config[section] or 'new-user' not in config[section]:
-            print(f"Warning: Skipping section {section} - missing old-user or new-user")
+        values = config[section]
+        if 'old-user' not in values or 'new-user' not in values:
+            print(f"Warning: Skipping section {section} of {filename} - missing old-user or new-user")
             continue
-            
-        old_username = config[section]['old-user']
-        print(f"\nProcessing section {section}:")
-        print(f"  Old username: {old_username}")
-        print(f"  New username: {config[section]['new-user']}")
-        print(f"  Password: {config[section].get('password', '[not set]')}")
         
-        credentials[old_username] = {
-            'new_username': config[section]['new-user'],
-            'credentials': config[section].get('password', '')  # For CLI credentials
-        }
+        if kind == 'snmp':
+            if 'auth-password' not in values or 'privacy-password' not in values:
+                print(f"Warning: Skipping section {section} of {filename} - missing auth-password or privacy-password")
+                continue
+            passwords = (values['auth-password'].strip(), values['privacy-password'].strip())
+        else:
+            passwords = (values.get('password', ''),)
         
-        # Handle SNMP specific fields if they exist
-        if 'auth-password' in config[section] and 'privacy-password' in config[section]:
-            credentials[old_username]['credentials'] = f"{config[section]['auth-password']},{config[section]['privacy-password']}"
-            
-    return credentials
+        if any('%%' in password for password in passwords):
+            print(f"Warning: a password in section {section} of {filename} contains '%%', which is used as is -"
+                  f" write a single '%' if it was escaped for an earlier version")
+        
+        try:
+            if rules.add(kind, values['old-user'], values['new-user'], passwords):
+                print(f"Warning: old-user {values['old-user']} is defined again in section {section} of {filename}"
+                      f" - the last section wins")
+        except re.error as e:
+            print(f"Warning: Skipping section {section} of {filename} - invalid old-user pattern: {e}")
+            continue
+        loaded += 1
+    
+    print(f"Loaded {loaded} rule(s) from {filename}")
+    return loaded
 
-def update_cli_credentials(device: Dict, credentials: Dict) -> tuple[Dict, bool]:
-    """Update CLI and HTTP(S) credentials and usernames for a device."""
-    device = device.copy()
-    access = device['deviceAccess']
-    changed = False
-    
-    print(f"\nChecking device: {device['name']}")
-    print(f"  CLI username: {access['cliUsername']}")
-    print(f"  HTTP username: {access['httpUsername']}")
-    print(f"  HTTPS username: {access['httpsUsername']}")
-    print("  Available credentials to match against:", list(credentials.keys()))
-    
-    # Update CLI credentials
-    if access['cliUsername'] in credentials:
-        print(f"  Found match for CLI username: {access['cliUsername']}")
-        cred_info = credentials[access['cliUsername']]
-        access['cliUsername'] = cred_info['new_username']
-        access['cliPassword'] = cred_info['credentials']
-        changed = True
-    
-    # Update HTTP credentials
-    if access['httpUsername'] in credentials:
-        print(f"  Found match for HTTP username: {access['httpUsername']}")
-        cred_info = credentials[access['httpUsername']]
-        access['httpUsername'] = cred_info['new_username']
-        access['httpPassword'] = cred_info['credentials']
-        changed = True
-    
-    # Update HTTPS credentials
-    if access['httpsUsername'] in credentials:
-        print(f"  Found match for HTTPS username: {access['httpsUsername']}")
-        cred_info = credentials[access['httpsUsername']]
-        access['httpsUsername'] = cred_info['new_username']
-        access['httpsPassword'] = cred_info['credentials']
-        changed = True
-    
-    return device, changed
-    
-    # Update CLI credentials
-    if access['cliUsername'] in credentials:
-        cred_info = credentials[access['cliUsername']]
-        access['cliUsername'] = cred_info['new_username']
-        access['cliPassword'] = cred_info['credentials']
-    
-    # Update HTTP credentials
-    if access['httpUsername'] in credentials:
-        cred_info = credentials[access['httpUsername']]
-        access['httpUsername'] = cred_info['new_username']
-        access['httpPassword'] = cred_info['credentials']
-    
-    # Update HTTPS credentials
-    if access['httpsUsername'] in credentials:
-        cred_info = credentials[access['httpsUsername']]
-        access['httpsUsername'] = cred_info['new_username']
-        access['httpsPassword'] = cred_info['credentials']
-    
-    return device
+def rotate_access(access: Dict, rules: RotationRules) -> Tuple[Dict, List[Tuple[str, str, str]]]:
+    """Apply every matching rule to a deviceAccess in one pass.
+    
+    Returns the deviceAccess and the list of (username field, old username,
+    new username) changes. When something changed the returned deviceAccess
+    is a new copy; the one passed in is never modified.
+    """
+    changes = []
+    updated = access
+    for kind, fields in ROTATED_FIELDS.items():
+        for username_field, password_fields in fields:
+            username = access.get(username_field)
+            if username is None:
+                continue
+            rule = rules.match(kind, username)
+            if rule is None:
+                continue
+            if updated is access:
+                updated = copy.deepcopy(access)
+            new_username, passwords = rule
+            updated[username_field] = new_username
+            for password_field, password in zip(password_fields, passwords):
+                updated[password_field] = password
+            changes.append((username_field, username, new_username))
+    return updated, changes
 
-def update_snmp_credentials(device: Dict, credentials: Dict) -> tuple[Dict, bool]:
-    """Update SNMP V3 credentials and username for a device."""
-    device = device.copy()
-    access = device['deviceAccess']
-    changed = False
-    
-    print(f"\nChecking SNMP for device: {device['name']}")
-    print(f"  SNMP V3 username: {access['snmpV3Username']}")
-    print("  Available SNMP credentials to match against:", list(credentials.keys()))
-    
-    if access['snmpV3Username'] in credentials:
-        print(f"  Found match for SNMP username: {access['snmpV3Username']}")
-        cred_info = credentials[access['snmpV3Username']]
-        access['snmpV3Username'] = cred_info['new_username']
-        
-        # Split the credentials into auth and privacy passwords
-        snmp_creds = cred_info['credentials'].split(',')
-        if len(snmp_creds) >= 2:
-            access['snmpV3AuthenticationPassword'] = snmp_creds[0].strip()
-            access['snmpV3PrivacyPassword'] = snmp_creds[1].strip()
-            changed = True
-    
-    return device, changed
-    
-    if access['snmpV3Username'] in credentials:
-        cred_info = credentials[access['snmpV3Username']]
-        access['snmpV3Username'] = cred_info['new_username']
-        
-        # Split the credentials into auth and privacy passwords
-        snmp_creds = cred_info['credentials'].split(',')
-        if len(snmp_creds) >= 2:
-            access['snmpV3AuthenticationPassword'] = snmp_creds[0].strip()
-            access['snmpV3PrivacyPassword'] = snmp_creds[1].strip()
+def rotate_device(device: Dict, rules: RotationRules) -> Tuple[Dict, List[Tuple[str, str, str]]]:
+    """Rotate the credentials of an exported device; see rotate_access()."""
+    access = device.get('deviceAccess')
+    if not isinstance(access, dict):
+        return device, []
+    access, changes = rotate_access(access, rules)
+    if not changes:
+        return device, []
+    device = copy.deepcopy(device)
+    device['deviceAccess'] = access
+    return device, changes
+
+class RotationReport:
+    """Counts of the changes of a rotation, printed as a few summary lines.
+    
+    With planned, the changes were not applied (dry run) and are reported
+    as changes to make.
+    """
+    
+    def __init__(self, planned: bool = False):
+        self.planned = planned
+        self.devices = 0
+        self.changed_devices = 0
+        self.changes = Counter()
+        self.usernames = Counter()
+        self.rows = []
     
-    return device
+    def add(self, device: Dict, changes: List[Tuple[str, str, str]]):
+        self.devices += 1
+        access = device.get('deviceAccess') or {}
+        for fields in ROTATED_FIELDS.values():
+            for username_field, _ in fields:
+                self.usernames[(username_field, access.get(username_field))] += 1
+        if not changes:
+            return
+        self.changed_devices += 1
+        for username_field, old_username, new_username in changes:
+            self.changes[(username_field, old_username, new_username)] += 1
+            self.rows.append((device.get('name'), device.get('managementIp'), username_field, old_username, new_username))
+    
+    def print_changes(self):
+        if self.planned:
+            print(f"\nCredentials to rotate (dry run, nothing was changed) on {self.changed_devices} of {self.devices} devices:")
+        else:
+            print(f"\nRotated credentials of {self.changed_devices} of {self.devices} devices:")
+        for (username_field, old_username, new_username), count in sorted(self.changes.items()):
+            print(f"  {username_field}: {old_username} -> {new_username}: {count} device(s)")
+    
+    def print_usernames(self):
+        print("\nCurrent usernames:")
+        for (username_field, username), count in sorted(self.usernames.items(), key=str):
+            print(f"  {username_field}: {username}: {count} device(s)")
+    
+    def write_csv(self, filename: str):
+        """Write one line per changed username (no passwords)."""
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'managementIp', 'field', 'old username',
+                             'planned new username' if self.planned else 'new username'])
+            writer.writerows(self.rows)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Rotate the CLI and SNMPv3 credentials of cyber_controller_organization.json '
+                                                 'with the rules of clicredentials.ini and snmpsecrets.ini')
+    add_profile_argument(parser)
+    return parser.parse_args()
 
 def main():
-    # Load the JSON configuration
-    config = load_json_config('cyber_controller_organization.json')
+    args = parse_arguments()
+    start_profiling(os.path.abspath('update_json_credentials'), args.profile)
+    
+    # The organization export, or the NDJSON file of a streamed download
+    input_filename = 'cyber_controller_organization.json'
+    if not os.path.exists(input_filename) and os.path.exists('cyber_controller_organization.ndjson'):
+        input_filename = 'cyber_controller_organization.ndjson'
     
-    # Try to load credentials from either INI file
-    cli_creds = load_credentials('clicredentials.ini')
-    snmp_creds = load_credentials('snmpsecrets.ini')
+    # Compile the rules of both INI files into one lookup table
+    rules = RotationRules()
+    with phase('load_rules'):
+        cli_rules = load_rules('clicredentials.ini', 'cli', rules)
+        snmp_rules = load_rules('snmpsecrets.ini', 'snmp', rules)
     
-    if not cli_creds and not snmp_creds:
+    if cli_rules is None and snmp_rules is None:
         print("Error: Neither clicredentials.ini nor snmpsecrets.ini found!")
         return
     
-    # Update devices with new credentials and usernames
-    updated_devices = []
-    any_changes = False
+    # Rotate the credentials of every device with all the rules. The export is
+    # read one record at a time and written out to a temporary file in the same pass
+    output_filename = 'cyber_controller_organization_updated.json'
+    report = RotationReport()
     
-    for device in config['devices']:
-        device_changed = False
-        
-        if cli_creds:
-            device, cli_changed = update_cli_credentials(device, cli_creds)
-            device_changed = device_changed or cli_changed
-            
-        if snmp_creds:
-            device, snmp_changed = update_snmp_credentials(device, snmp_creds)
-            device_changed = device_changed or snmp_changed
-            
-        if device_changed:
-            print(f"\nUpdated credentials for device: {device['name']}")
-            any_changes = True
-            
-        updated_devices.append(device)
-    
-    # Update the configuration with new credentials
-    config['devices'] = updated_devices
+    with phase('rotate'), JsonExportWriter(output_filename + '.tmp') as writer:
+        for kind, record in iter_export_records(input_filename):
+            if kind == "device":
+                record, changes = rotate_device(record, rules)
+                report.add(record, changes)
+            writer.write(kind, record)
     
     # Save the updated configuration if changes were made
-    if any_changes:
-        output_filename = 'cyber_controller_organization_updated.json'
+    if report.changed_devices:
+        report.print_changes()
         print(f"\nSaving changes to {output_filename}")
         try:
-            with open(output_filename, 'w') as f:
-                json.dump(config, f, indent=4)
+            os.replace(writer.filename, output_filename)
             print(f"Configuration successfully saved to {output_filename}")
+            report_filename = os.path.splitext(output_filename)[0] + '_report.csv'
+            with phase('report_write'):
+                report.write_csv(report_filename)
+            print(f"List of the changed usernames saved to {report_filename}")
         except Exception as e:
             print(f"Error saving file: {str(e)}")
     else:
         print("\nNo changes were made to any devices - no new file created")
-        print("\nDebug summary of current usernames:")
-        for device in config['devices']:
-            print(f"  Device {device['name']}:")
-            print(f"    CLI user: {device['deviceAccess']['cliUsername']}")
-            print(f"    HTTP user: {device['deviceAccess']['httpUsername']}")
-            print(f"    HTTPS user: {device['deviceAccess']['httpsUsername']}")
-            print(f"    SNMP V3 user: {device['deviceAccess']['snmpV3Username']}")
+        os.remove(writer.filename)
+        report.print_usernames()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,18 +1,31 @@
 import time
 import requests
-import urllib3
 import json
 import os
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
 from getpass import getpass
 import logging
+from cyber_controller_inventory import Inventory
+from cyber_controller_client import (CyberControllerClient, orm_id_from_response, DEFAULT_CONCURRENCY,
+                                     DEFAULT_SESSION_CACHE_SECONDS)
+from cyber_controller_journal import Journal
+from cyber_controller_db import load_tree, DEFAULT_DB_FILE
+from cyber_controller_metrics import write_run_metrics
+from cyber_controller_profile import add_profile_argument, start_profiling
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 current_working_directory = os.path.abspath(os.getcwd()) + os.path.sep
 log = current_working_directory + 'upload_cybercontroller_objects.log'
 logging.basicConfig(filename=log, filemode='w', format='%(asctime)s - %(message)s',
                     level=logging.INFO)
 
+DEVICE_POLL_TIMEOUT = 600
+DEVICE_POLL_INTERVAL = 5
+# Environment variable with the path of the credentials file to read instead of ./upload.ini
+CONFIG_FILE_VARIABLE = 'CYBER_CONTROLLER_UPLOAD_INI'
+
 def get_console_input():
     print("--- Destination Cyber-Controller Details ---")
     ip = input("Address: ")
@@ -26,7 +39,8 @@ def get_console_input():
 
 def load_config():
     config = ConfigParser()
-    config_file = 'upload.ini'
+    # The shard workers are pointed to the upload.ini of the sharding run
+    config_file = os.environ.get(CONFIG_FILE_VARIABLE, 'upload.ini')
     
     if not os.path.exists(config_file):
         logging.info("Configuration file not found. Falling back to console input.")
@@ -49,44 +63,9 @@ def load_config():
         print("Falling back to manual input.")
         return get_console_input()
 
-def login_cyber_controller(ip, user, password):
-    headers = {
-        'authority': ip,
-        'accept': 'application/json; */*',
-        "accept-encoding": "gzip, deflate, br",
-        'accept-language': 'en-US,en;q=0.9,he;q=0.8',
-        'content-type': 'application/json',
-        'sec-ch-ua': '"Google Chrome";v="113", "Chromium";v="113", "Not-A.Brand";v="24"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'supportasync': 'true',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)'
-                      ' Chrome/113.0.0.0 Safari/537.36'
-    }
-
-    with requests.sessions.Session() as session:
-        session.auth = (user, password)
-        session.verify = False
-        session.headers = headers
-
-    login_data = '{"username":"' + user + '","password":"' + password + '"}'
-    login_url = 'https://' + ip + '/mgmt/system/user/login'
-    login_response = session.post(login_url, headers=headers, verify=False, data=login_data)
-    if login_response.status_code != 200:
-        print("Cyber-Controller " + ip + " login status code:", login_response.status_code)
-        logging.error("Cyber-Controller " + ip + " login status code: " + str(login_response.status_code))
-        logging.info('Finishing the script.')
-        exit(1)
-    else:
-        return session
-
-def get_parent_site_id(parent_site_name, session, dst_cc_ip):
-    parent_site_name_url = 'https://' + dst_cc_ip + '/mgmt/system/config/tree/site/byname/' + parent_site_name
+def get_parent_site_id(parent_site_name, client):
     try:
-        parent_site_name_response = session.get(parent_site_name_url, verify=False)
+        parent_site_name_response = client.get('/mgmt/system/config/tree/site/byname/' + parent_site_name)
         data = json.loads(parent_site_name_response.text)
         
         # Debug logging to see the actual response
@@ -97,13 +76,10 @@ def get_parent_site_id(parent_site_name, session, dst_cc_ip):
             logging.info(f"No site found with name: {parent_site_name}")
             return False
             
-        # Check if we have a valid response with meIdentifier
-        if 'meIdentifier' in data and 'managedElementID' in data['meIdentifier']:
-            return data['meIdentifier']['managedElementID']
-        
-        # If we have ormID directly
-        if 'ormID' in data:
-            return data['ormID']
+        # Check if we have a valid response with meIdentifier or ormID
+        parent_site_id = orm_id_from_response(data)
+        if parent_site_id:
+            return parent_site_id
             
         # If we couldn't find any valid ID
         logging.error(f"Unexpected API response format for site {parent_site_name}: {data}")
@@ -119,14 +95,6 @@ def get_parent_site_id(parent_site_name, session, dst_cc_ip):
         logging.error(f"Unexpected error getting parent site ID for {parent_site_name}: {str(e)}")
         return False
 
-def get_site_name_by_id(site_id, json_data):
-    site_name = None
-    for site in json_data['sites']:
-        if site['id'] == site_id:
-            site_name = site['name']
-            break
-    return site_name
-
 def load_json_file(filename):
     try:
         with open(filename, 'r') as f:
@@ -140,86 +108,378 @@ def load_json_file(filename):
         print(f"Error: Invalid JSON format in file {filename}")
         return None
 
-def upload_configuration(dst_cc_ip, dst_cc_user, dst_cc_password, json_data, tree_type):
-    dst_session = login_cyber_controller(dst_cc_ip, dst_cc_user, dst_cc_password)
-    
-    # Get root site information
-    url = f'https://{dst_cc_ip}/mgmt/system/config/tree/{tree_type}'
-    response = dst_session.get(url, verify=False)
-    data = json.loads(response.text)
-    dst_cc_root_site_id = data["meIdentifier"]["managedElementID"]
+def response_message(response):
+    """Return the error message of a failed request, or its status code when the body has none."""
+    try:
+        return response.json()['message']
+    except (ValueError, KeyError, TypeError):
+        return f"status code {response.status_code}"
 
-    # Upload sites
-    for site in json_data["sites"]:
-        site_name = site["name"]
-        parent_site_name = site["parent_site_name"]
+def response_orm_id(response):
+    try:
+        return orm_id_from_response(response.json())
+    except ValueError:
+        return None
+
+def load_upload_journal(journal, destination):
+    """Read what a previous run already created from its journal.
+
+    The sites are added to the destination inventory so their children can
+    be placed without a lookup. Returns the names of the uploaded sites and
+    the managementIps of the uploaded devices.
+    """
+    uploaded_sites = set()
+    uploaded_devices = set()
+    for record in journal.records():
+        if record.get("record") == "site":
+            uploaded_sites.add(record["name"])
+            if not destination.site_id_by_name(record["name"]):
+                destination.add_site({
+                    "name": record["name"],
+                    "id": record["ormID"],
+                    "parent_site_name": record["parent_site_name"],
+                    "parentOrmID": destination.site_id_by_name(record["parent_site_name"]) or destination.root_id
+                })
+        elif record.get("record") == "device":
+            uploaded_devices.add(record["managementIp"])
+    return uploaded_sites, uploaded_devices
+
+def create_site(site, parent_site_id, client):
+    """POST one site and return its ormID on the destination, or None if it failed."""
+    site_name = site["name"]
+    payload = {
+        "parentOrmID": parent_site_id,
+        "name": site_name
+    }
+    try:
+        response = client.post('/mgmt/system/config/tree/site', json=payload)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to add site: {site_name}")
+        logging.error(f"Failed to add site - {site_name} {str(e)}")
+        return None
+    if response.status_code != 200:
+        print(f"Failed to add site: {site_name}")
+        logging.error(f"Failed to add site - {site_name} {response_message(response)}")
+        return None
+
+    print(f"Added site: {site_name}")
+    logging.info(f"Added site: {site_name}")
+    # Older versions don't return the new ormID, look it up by name instead
+    return response_orm_id(response) or get_parent_site_id(site_name, client)
+
+def upload_sites(client, inventory, destination, journal=None, uploaded_sites=(), report=None):
+    """Create the sites wave by wave, each wave (one tree depth) in parallel.
+
+    Parent ormIDs are resolved from the destination tree fetched once before
+    the upload; the ormID of every site created in a wave is added to it, so
+    its children in the next wave need no lookup. Sites that already exist
+    on the destination, or that the journal of a previous run recorded as
+    uploaded, are skipped. Each created site is recorded in the journal and
+    every outcome is counted in report.
+    """
+    report = report if report is not None else Counter()
 
-        parent_site_id = get_parent_site_id(parent_site_name, dst_session, dst_cc_ip)
-        if not parent_site_id:
-            parent_site_id = dst_cc_root_site_id
+    def upload_site(site):
+        parent_site_id = destination.site_id_by_name(site["parent_site_name"]) or destination.root_id
+        return create_site(site, parent_site_id, client)
 
-        payload = {
-            "parentOrmID": parent_site_id,
-            "name": site_name
+    with ThreadPoolExecutor(max_workers=client.concurrency) as executor:
+        for wave in inventory.sites_by_depth():
+            new_sites = []
+            for site in wave:
+                if site["name"] in uploaded_sites:
+                    logging.info(f"Skipped site, already uploaded: {site['name']}")
+                    report['sites_resumed'] += 1
+                elif destination.site_id_by_name(site["name"]):
+                    report['sites_existing'] += 1
+                    print(f"Site already exists: {site['name']}")
+                    logging.info(f"Skipped site, already exists: {site['name']}")
+                else:
+                    new_sites.append(site)
+
+            for site, site_id in zip(new_sites, executor.map(upload_site, new_sites)):
+                report['sites_created' if site_id else 'sites_failed'] += 1
+                if site_id:
+                    destination.add_site({
+                        "name": site["name"],
+                        "id": site_id,
+                        "parent_site_name": site["parent_site_name"],
+                        "parentOrmID": destination.site_id_by_name(site["parent_site_name"]) or destination.root_id
+                    })
+                    if journal:
+                        journal.append({"record": "site", "name": site["name"], "ormID": site_id,
+                                        "parent_site_name": site["parent_site_name"]})
+
+def add_device(device, parent_orm_id, client, async_request=False):
+    """POST one device.
+
+    Returns the new ormID when the controller accepted the device (an empty
+    string if the response has none), None if it failed. With async_request
+    the controller may answer 202 before the device is registered;
+    wait_for_devices() then polls for the result.
+    """
+    device_name = device['name']
+    payload = {
+        "name": device['name'],
+        "parentOrmID": parent_orm_id,
+        "type": device['type'],
+        "deviceSetup": {
+            "deviceAccess": device['deviceAccess']
         }
-        url = f'https://{dst_cc_ip}/mgmt/system/config/tree/site'
-
-        response = dst_session.post(url, verify=False, json=payload)
-        print(response)
-        if response.status_code != 200:
-            print(f"Failed to add site: {site_name}")
-            error = response.json()
-            logging.error(f"Failed to add site - {site_name} {error['message']}")
-        else:
-            print(f"Added site: {site_name}")
-            logging.info(f"Added site: {site_name}")
+    }
 
-    # Upload devices
-    for device in json_data["devices"]:
+    try:
+        response = client.post('/mgmt/system/config/tree/device', json=payload)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to add device: {device_name}")
+        logging.error(f"Failed to add device - {device_name} {str(e)}")
+        return None
+    if response.status_code not in ((200, 202) if async_request else (200,)):
+        print(f"Failed to add device: {device_name}")
+        logging.error(f"Failed to add device - {device_name} {response_message(response)}")
+        return None
+
+    if async_request:
+        logging.info(f"Submitted device: {device_name}")
+    else:
+        print(f"Added device: {device_name}")
+        logging.info(f"Added device: {device_name}")
+    return response_orm_id(response) or ''
+
+def is_device_registered(device, client):
+    try:
+        response = client.get('/mgmt/system/config/tree/device/byip/' + device['managementIp'])
+        return response.status_code == 200 and bool(response.json().get('deviceSetup'))
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Failed to get state of device {device['name']}: {str(e)}")
+        return False
+
+def wait_for_devices(client, devices, timeout=DEVICE_POLL_TIMEOUT, interval=DEVICE_POLL_INTERVAL):
+    """Poll the submitted devices together until all are registered or the timeout expires.
+
+    Every round checks all the pending devices, client.concurrency at a time.
+    Returns the registered and the still pending devices.
+    """
+    registered = []
+    pending = list(devices)
+    deadline = time.monotonic() + timeout
+
+    with ThreadPoolExecutor(max_workers=client.concurrency) as executor:
+        while pending:
+            states = list(executor.map(lambda device: is_device_registered(device, client), pending))
+            registered.extend(device for device, done in zip(pending, states) if done)
+            pending = [device for device, done in zip(pending, states) if not done]
+            if not pending or time.monotonic() + interval > deadline:
+                break
+            time.sleep(interval)
+
+    return registered, pending
+
+def upload_devices(client, inventory, destination, async_devices=False,
+                   poll_timeout=DEVICE_POLL_TIMEOUT, poll_interval=DEVICE_POLL_INTERVAL,
+                   journal=None, uploaded_devices=(), report=None):
+    report = report if report is not None else Counter()
+
+    def record_device(device, device_id):
+        if journal and device_id is not None:
+            journal.append({"record": "device", "name": device['name'],
+                            "managementIp": device['managementIp'], "ormID": device_id})
+
+    devices_to_add = []
+    for device in inventory.devices:
         device_name = device['name']
+        if device['managementIp'] in uploaded_devices:
+            logging.info(f"Skipped device, already uploaded: {device_name}")
+            report['devices_resumed'] += 1
+            continue
+        if destination.device_by_ip(device['managementIp']):
+            print(f"Device already exists: {device_name}")
+            logging.info(f"Skipped device, already exists: {device_name}")
+            report['devices_existing'] += 1
+            continue
+        if 'deviceAccess' not in device:
+            # The download could not get it, the device cannot be added without it
+            print(f"Failed to add device: {device_name}")
+            logging.error(f"Failed to add device - {device_name} no deviceAccess in the file")
+            report['devices_failed'] += 1
+            continue
+
         src_parent_device_id = device['parentOrmID']
-        parent_site_name = get_site_name_by_id(src_parent_device_id, json_data)
+        parent_site_name = inventory.site_name(src_parent_device_id)
 
-        parent_orm_id = dst_cc_root_site_id if not parent_site_name else get_parent_site_id(parent_site_name, dst_session, dst_cc_ip)
+        parent_orm_id = destination.root_id if not parent_site_name else destination.site_id_by_name(parent_site_name)
+        if not parent_orm_id:
+            print(f"Failed to add device: {device_name}")
+            logging.error(f"Failed to add device - {device_name} parent site {parent_site_name} not found")
+            report['devices_failed'] += 1
+            continue
 
-        payload = {
-            "name": device['name'],
-            "parentOrmID": parent_orm_id,
-            "type": device['type'],
-            "deviceSetup": {
-                "deviceAccess": device['deviceAccess']
-            }
-        }
+        devices_to_add.append((device, parent_orm_id))
 
-        url = f'https://{dst_cc_ip}/mgmt/system/config/tree/device'
-        response = dst_session.post(url, verify=False, json=payload)
-        if response.status_code != 200:
-            print(f"Failed to add device: {device_name}")
-            error = response.json()
-            logging.error(f"Failed to add device - {device_name} {error['message']}")
-        else:
-            print(f"Added device: {device_name}")
-            logging.info(f"Added device: {device_name}")
+    if not async_devices:
+        for device, parent_orm_id in devices_to_add:
+            device_id = add_device(device, parent_orm_id, client)
+            report['devices_added' if device_id is not None else 'devices_failed'] += 1
+            record_device(device, device_id)
+        return
+
+    # Submit all the devices without waiting for each registration, then poll them together
+    print(f"Submitting {len(devices_to_add)} devices...")
+    submitted = []
+    with ThreadPoolExecutor(max_workers=client.concurrency) as executor:
+        futures = {executor.submit(add_device, device, parent_orm_id, client, async_request=True): device
+                   for device, parent_orm_id in devices_to_add}
+        try:
+            for future in as_completed(futures):
+                device = futures[future]
+                device_id = future.result()
+                if device_id is not None:
+                    submitted.append((device, device_id))
+        finally:
+            # Interrupted: the devices not posted yet are not posted at all
+            for future in futures:
+                future.cancel()
+
+    print(f"Waiting for {len(submitted)} devices to be registered...")
+    device_ids = {device['managementIp']: device_id for device, device_id in submitted}
+    registered, pending = wait_for_devices(client, [device for device, _ in submitted], poll_timeout, poll_interval)
+
+    # Only registered devices are journaled: a device still pending, or not polled
+    # because the run was interrupted, is checked again by the next run
+    for device in registered:
+        record_device(device, device_ids[device['managementIp']])
+        print(f"Added device: {device['name']}")
+        logging.info(f"Added device: {device['name']}")
+    for device in pending:
+        print(f"Device not registered after {poll_timeout} seconds: {device['name']}")
+        logging.error(f"Device not registered after {poll_timeout} seconds - {device['name']}")
+
+    report['devices_added'] += len(registered)
+    report['devices_not_registered'] += len(pending)
+    report['devices_failed'] += len(devices_to_add) - len(submitted)
+    print(f"Devices added: {len(registered)}, not registered: {len(pending)}, "
+          f"failed: {len(devices_to_add) - len(submitted)}")
+
+def upload_configuration(client, json_data, tree_type, async_devices=False,
+                         poll_timeout=DEVICE_POLL_TIMEOUT, poll_interval=DEVICE_POLL_INTERVAL, resume=False,
+                         report=None):
+    """Upload the sites and devices of json_data to the tree_type tree.
+
+    Every object created on the destination is recorded with its new ormID
+    in cyber_controller_<tree>_upload.journal as soon as the POST succeeds (with
+    async_devices, once the device is registered). With resume the objects
+    recorded by a previous run are skipped without any request.
+    The outcome of every site and device is counted in report (a Counter).
+    Returns the journal.
+    """
+    # Get the destination tree once, all parent sites are resolved from it
+    with client.metrics.phase('tree_fetch'):
+        response = client.get(f'/mgmt/system/config/tree/{tree_type}')
+        data = json.loads(response.text)
+        destination = Inventory.from_tree(data)
+    inventory = Inventory(json_data)
+
+    journal = Journal(f'cyber_controller_{tree_type.lower()}_upload.journal', resume)
+    uploaded_sites, uploaded_devices = load_upload_journal(journal, destination) if resume else (set(), set())
+    if uploaded_sites or uploaded_devices:
+        print(f"Resuming: {len(uploaded_sites)} sites and {len(uploaded_devices)} devices already uploaded")
+
+    # Upload sites
+    with client.metrics.phase('site_create'):
+        upload_sites(client, inventory, destination, journal, uploaded_sites, report)
+
+    # Upload devices
+    with client.metrics.phase('device_create'):
+        upload_devices(client, inventory, destination, async_devices, poll_timeout, poll_interval,
+                       journal, uploaded_devices, report)
+
+    journal.close()
+    return journal
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Upload Cyber-Controller objects from JSON files')
+    parser.add_argument('-c', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Number of parallel requests (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('-a', '--async-devices', action='store_true',
+                        help='Submit all devices without waiting for each one, then poll for their registration')
+    parser.add_argument('--poll-timeout', type=int, default=DEVICE_POLL_TIMEOUT,
+                        help=f'Seconds to wait for submitted devices to be registered (default: {DEVICE_POLL_TIMEOUT})')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Skip the objects a previous interrupted upload already created')
+    parser.add_argument('--poll-interval', type=int, default=DEVICE_POLL_INTERVAL,
+                        help=f'Seconds between polls of submitted devices (default: {DEVICE_POLL_INTERVAL})')
+    parser.add_argument('-s', '--sqlite', nargs='?', const=DEFAULT_DB_FILE, default=None, metavar='DB',
+                        help=f'Read both trees from an SQLite database written by the download instead of the'
+                             f' JSON files (default file: {DEFAULT_DB_FILE})')
+    parser.add_argument('--report', default=None,
+                        help='Write a JSON summary of the sites and devices created, skipped and failed to this file')
+    parser.add_argument('--session-cache', type=int, default=DEFAULT_SESSION_CACHE_SECONDS, metavar='SECONDS',
+                        help=f'Reuse the login session of a previous run up to this many seconds after its login,'
+                             f' 0 to always log in (default: {DEFAULT_SESSION_CACHE_SECONDS})')
+    add_profile_argument(parser)
+    return parser.parse_args()
 
 def main():
     logging.info('Starting the script.')
+
+    # Parse command line arguments
+    args = parse_arguments()
+    start_profiling(os.path.splitext(log)[0], args.profile)
     
     # Load credentials from config file or fall back to console input
     credentials = load_config()
+
+    # Log in once and share the session for both trees
+    client = CyberControllerClient(credentials['ip'], credentials['username'], credentials['password'],
+                                   args.concurrency, supportasync=True,
+                                   session_cache_seconds=args.session_cache)
     
+    journals = []
+    # Outcome counts per tree, for --report
+    reports = {}
+
     # Load and process Physical tree configuration
-    physical_json = load_json_file('cyber_controller_physical.json')
+    if args.sqlite:
+        physical_json = load_tree(args.sqlite, 'physical')
+    else:
+        physical_json = load_json_file('cyber_controller_physical.json')
     if physical_json:
         print("\nUploading Physical tree configuration...")
-        upload_configuration(credentials['ip'], credentials['username'], credentials['password'], 
-                           physical_json, 'Physical')
+        reports['physical'] = Counter()
+        journals.append(upload_configuration(client, physical_json, 'Physical', args.async_devices,
+                                             args.poll_timeout, args.poll_interval, args.resume,
+                                             reports['physical']))
 
     # Load and process Organization tree configuration
-    organization_json = load_json_file('cyber_controller_organization.json')
+    if args.sqlite:
+        organization_json = load_tree(args.sqlite, 'organization')
+    else:
+        organization_json = load_json_file('cyber_controller_organization.json')
     if organization_json:
         print("\nUploading Organization tree configuration...")
-        upload_configuration(credentials['ip'], credentials['username'], credentials['password'], 
-                           organization_json, 'Organization')
+        reports['organization'] = Counter()
+        journals.append(upload_configuration(client, organization_json, 'Organization', args.async_devices,
+                                             args.poll_timeout, args.poll_interval, args.resume,
+                                             reports['organization']))
+
+    client.close()
+
+    # The upload finished, the journals are not needed to resume anymore, unless
+    # some devices were not registered yet: a run with --resume checks them again
+    not_registered = sum(report['devices_not_registered'] for report in reports.values())
+    if not_registered:
+        print(f"{not_registered} device(s) not registered yet, the journal files are kept: "
+              f"run again with --resume to check them")
+        logging.info(f"Kept the upload journals, {not_registered} device(s) not registered")
+    else:
+        for journal in journals:
+            journal.remove()
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(reports, f, indent=4)
+
+    write_run_metrics(client.metrics, log)
 
     logging.info('Finishing the script.')
     print("\nDone.")